@@ -1,15 +1,22 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from .allocation import leave_native_sequence, sync_native_sequence
 from .models import (
+    ApiToken,
+    Blob,
     Department,
     Document,
     Year,
     Sequence,
+    SequenceGap,
     Emission,
     EmissionFile,
     UserDepartment,
     CustomUser,
     GlobalSettings,
+    Job,
+    Reservation,
+    UploadSession,
 )
 
 
@@ -24,13 +31,45 @@ class GlobalSettingsAdmin(admin.ModelAdmin):
         return not GlobalSettings.objects.exists()
 
 
+class SequenceAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        if (
+            change
+            and "allocation" in form.changed_data
+            and form.initial.get("allocation") == Sequence.NATIVE
+        ):
+            leave_native_sequence(obj)
+        super().save_model(request, obj, form, change)
+        if not change or {"sequence", "allocation"} & set(form.changed_data):
+            sync_native_sequence(obj)
+
+
+class ApiTokenAdmin(admin.ModelAdmin):
+    fields = ["user", "name", "is_active"]
+    list_display = ["name", "user", "last_used_at", "is_active"]
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            token = obj.set_token()
+            messages.warning(
+                request, f"API token for {obj.name}: {token} (it will not be shown again)"
+            )
+        super().save_model(request, obj, form, change)
+
+
 admin.site.register(GlobalSettings, GlobalSettingsAdmin)
 
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Department)
 admin.site.register(Document)
 admin.site.register(Year)
-admin.site.register(Sequence)
+admin.site.register(Sequence, SequenceAdmin)
+admin.site.register(SequenceGap)
 admin.site.register(Emission)
 admin.site.register(EmissionFile)
+admin.site.register(Blob)
 admin.site.register(UserDepartment)
+admin.site.register(Job)
+admin.site.register(Reservation)
+admin.site.register(UploadSession)
+admin.site.register(ApiToken, ApiTokenAdmin)
@@ -0,0 +1,354 @@
+import atexit
+import threading
+
+from django.db import IntegrityError, ProgrammingError, connections, transaction
+from django.db.models import F
+
+from .models import Sequence, SequenceGap
+
+# SQLSTATE of a missing relation, nextval on a SEQUENCE not created yet.
+UNDEFINED_TABLE = "42P01"
+
+# Hi-lo blocks reserved by this process, sequence pk -> range of unused numbers.
+_blocks = {}
+_blocks_lock = threading.Lock()
+# Numbers served from a block to a transaction not committed yet, as
+# [sequence pk, numbers, on_commit callback, thread]. Django has no rollback
+# hook: a callback dropped from the pending on_commit list of its connection
+# means the transaction rolled back, and the numbers go to the gap ledger.
+_served = []
+
+
+def _supports_update_returning(connection):
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def _update_returning(connection, sequence_id, quantity):
+    # UPDATE ... RETURNING: the increment and the read of the new value are a
+    # single statement, the row lock is taken by the UPDATE itself.
+    qn = connection.ops.quote_name
+    sql = (
+        f"UPDATE {qn(Sequence._meta.db_table)} "
+        f"SET {qn('sequence')} = {qn('sequence')} + %s "
+        f"WHERE {qn('id')} = %s AND {qn('is_active')} "
+        f"RETURNING {qn('sequence')}"
+    )
+    pk = Sequence._meta.pk.get_db_prep_value(sequence_id, connection)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [quantity, pk])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _update_then_select(using, sequence_id, quantity):
+    # Fallback for backends without UPDATE ... RETURNING. The UPDATE locks the
+    # row until the surrounding transaction ends, so the read is still ours.
+    queryset = Sequence.objects.using(using).filter(pk=sequence_id)
+    if not queryset.update(sequence=F("sequence") + quantity):
+        return None
+    return queryset.values_list("sequence", flat=True).get()
+
+
+def _increment(sequence_id, quantity):
+    using = Sequence.objects.db
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        if _supports_update_returning(connection):
+            last = _update_returning(connection, sequence_id, quantity)
+        else:
+            last = _update_then_select(using, sequence_id, quantity)
+    if last is None:
+        raise Sequence.DoesNotExist("No such sequence")
+    return range(last - quantity + 1, last + 1)
+
+
+def record_gap(sequence_id, numbers, reason):
+    if numbers:
+        SequenceGap.objects.create(
+            sequence_id=sequence_id,
+            start=numbers[0],
+            end=numbers[-1],
+            reason=reason,
+        )
+
+
+def _publish_block(sequence_id, numbers):
+    with _blocks_lock:
+        # Another thread may have published a block meanwhile, keep one only.
+        replaced = _blocks.pop(sequence_id, None)
+        if numbers:
+            _blocks[sequence_id] = numbers
+    # Outside the lock, a database round trip must not hold up the other
+    # allocations of the process.
+    record_gap(sequence_id, replaced, "block replaced")
+
+
+def _drop_block(sequence_id, reason):
+    with _blocks_lock:
+        dropped = _blocks.pop(sequence_id, None)
+    record_gap(sequence_id, dropped, reason)
+
+
+def _await_commit(entry):
+    def committed():
+        with _blocks_lock:
+            if entry in _served:
+                _served.remove(entry)
+
+    entry[2] = committed
+    with _blocks_lock:
+        if not any(served is entry for served in _served):
+            _served.append(entry)
+    transaction.on_commit(committed, using=Sequence.objects.db)
+
+
+def _record_rolled_back():
+    """
+    Records the numbers served to transactions of this thread that rolled
+    back. Only the thread of a transaction can tell, its callbacks are not
+    touched by the others.
+    """
+    if not _served:
+        return
+    connection = transaction.get_connection(Sequence.objects.db)
+    waiting = {id(hook[1]) for hook in connection.run_on_commit}
+    thread = threading.get_ident()
+    with _blocks_lock:
+        lost = [
+            entry
+            for entry in _served
+            if entry[3] == thread and id(entry[2]) not in waiting
+        ]
+    for entry in lost:
+        record_gap(entry[0], entry[1], "rolled back")
+        # the gap itself is rolled back with the current transaction, the
+        # numbers wait for its commit as well
+        _await_commit(entry)
+
+
+def _allocate_from_block(sequence, quantity):
+    with _blocks_lock:
+        block = _blocks.get(sequence.pk)
+        if block is not None and len(block) >= quantity:
+            _blocks[sequence.pk] = block[quantity:]
+            numbers = block[:quantity]
+        else:
+            numbers = None
+    if numbers is not None:
+        # The counter already moved past these numbers, a rollback of the
+        # caller can not give them back.
+        _await_commit([sequence.pk, numbers, None, threading.get_ident()])
+        return numbers
+    block = _increment(sequence.pk, max(sequence.block_size, quantity))
+    # The rest of the block is only served once the reservation is committed,
+    # a rolled back reservation must not leave numbers behind in memory.
+    # Batches need contiguous numbers, an undersized remainder is replaced
+    # then too: until the commit it is still ours and nothing is lost when
+    # the caller rolls back.
+    transaction.on_commit(
+        lambda: _publish_block(sequence.pk, block[quantity:]),
+        using=Sequence.objects.db,
+    )
+    return block[:quantity]
+
+
+def native_sequence_name(sequence):
+    return f"emission_seq_{sequence.pk.hex}"
+
+
+def _uses_native_sequence(sequence):
+    return (
+        sequence.allocation == Sequence.NATIVE
+        and connections[Sequence.objects.db].vendor == "postgresql"
+    )
+
+
+# Last number handed out by a SEQUENCE, read from the SEQUENCE itself.
+_NATIVE_VALUE = "CASE WHEN is_called THEN last_value ELSE last_value - 1 END"
+
+
+def _native_value(cursor, name):
+    cursor.execute(f"SELECT {_NATIVE_VALUE} FROM {name}")
+    return cursor.fetchone()[0]
+
+
+def _create_native_sequence(cursor, name, start):
+    # Seeded by the CREATE itself, no other worker can take a number from
+    # the SEQUENCE before it starts after ``start``.
+    try:
+        with transaction.atomic(using=Sequence.objects.db):
+            cursor.execute(
+                f"CREATE SEQUENCE IF NOT EXISTS {name} "
+                f"MINVALUE 0 START WITH {int(start) + 1}"
+            )
+    except IntegrityError:
+        # Another worker created it at the same time.
+        pass
+
+
+def sync_native_sequence(sequence):
+    """
+    Creates the PostgreSQL SEQUENCE backing a native sequence when it is
+    missing and moves it forward to ``sequence.sequence``. It never moves
+    backwards: the column is a lazy mirror and may be behind numbers
+    already handed out. Call it whenever the counter is edited by hand.
+    """
+    if not _uses_native_sequence(sequence):
+        return
+    name = native_sequence_name(sequence)
+    with connections[Sequence.objects.db].cursor() as cursor:
+        _create_native_sequence(cursor, name, sequence.sequence)
+        cursor.execute(
+            f"SELECT setval(%s, %s, true) FROM {name} WHERE {_NATIVE_VALUE} < %s",
+            [name, sequence.sequence, sequence.sequence],
+        )
+
+
+def leave_native_sequence(sequence):
+    """
+    Copies the value of the PostgreSQL SEQUENCE back into ``sequence.sequence``
+    and drops it, so the sequence can go back to row based allocation without
+    reissuing numbers. The caller saves the sequence.
+    """
+    if connections[Sequence.objects.db].vendor != "postgresql":
+        return
+    name = native_sequence_name(sequence)
+    with connections[Sequence.objects.db].cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0] is None:
+            return
+        sequence.sequence = max(sequence.sequence, _native_value(cursor, name))
+        cursor.execute(f"DROP SEQUENCE {name}")
+
+
+def drop_native_sequence(sequence):
+    """
+    Drops the PostgreSQL SEQUENCE of a sequence deleted for good, if it has
+    one.
+    """
+    if connections[Sequence.objects.db].vendor != "postgresql":
+        return
+    with connections[Sequence.objects.db].cursor() as cursor:
+        cursor.execute(f"DROP SEQUENCE IF EXISTS {native_sequence_name(sequence)}")
+
+
+def refresh_native_mirrors(sequences):
+    """
+    Updates the ``sequence`` column of native sequences from their database
+    SEQUENCE. The column is only a mirror for display, it is refreshed lazily
+    when the sequences are listed.
+    """
+    for sequence in sequences:
+        if not _uses_native_sequence(sequence):
+            continue
+        with connections[Sequence.objects.db].cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [native_sequence_name(sequence)])
+            if cursor.fetchone()[0] is None:
+                continue
+            current = _native_value(cursor, native_sequence_name(sequence))
+        if current > sequence.sequence:
+            Sequence.objects.filter(pk=sequence.pk, sequence__lt=current).update(
+                sequence=current
+            )
+            sequence.sequence = current
+
+
+def _allocate_native(sequence, quantity):
+    # nextval never blocks and is never rolled back, concurrent batches may
+    # interleave so the numbers are ascending but not always consecutive.
+    name = native_sequence_name(sequence)
+    sql = "SELECT nextval(%s) FROM generate_series(1, %s)"
+    try:
+        with transaction.atomic(using=Sequence.objects.db):
+            with connections[Sequence.objects.db].cursor() as cursor:
+                cursor.execute(sql, [name, quantity])
+                return sorted(row[0] for row in cursor.fetchall())
+    except ProgrammingError as error:
+        if getattr(error.__cause__, "pgcode", None) != UNDEFINED_TABLE:
+            raise
+    # First allocation since the sequence switched to native mode, it starts
+    # after the committed counter and not after a possibly stale instance.
+    counter = Sequence.objects.filter(pk=sequence.pk).values_list("sequence", flat=True)
+    with connections[Sequence.objects.db].cursor() as cursor:
+        _create_native_sequence(cursor, name, max(counter.get(), sequence.sequence))
+        cursor.execute(sql, [name, quantity])
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def release_blocks(reason="process exit"):
+    """
+    Gives back every hi-lo block held by this process, recording the unused
+    numbers in the gap ledger so audits still reconcile.
+    """
+    _record_rolled_back()
+    with _blocks_lock:
+        blocks = list(_blocks.items())
+        _blocks.clear()
+    for sequence_id, numbers in blocks:
+        record_gap(sequence_id, numbers, reason)
+
+
+@atexit.register
+def _release_blocks_on_exit():
+    try:
+        release_blocks()
+        # nothing commits any more, the numbers of every open transaction
+        # are lost
+        with _blocks_lock:
+            served = list(_served)
+            _served.clear()
+        for sequence_id, numbers, _, _ in served:
+            record_gap(sequence_id, numbers, "process exit")
+    except Exception:
+        # The database may already be gone during interpreter shutdown.
+        pass
+
+
+def allocate(sequence, quantity=1):
+    """
+    Atomically reserves ``quantity`` consecutive numbers from a sequence.
+
+    Gapless sequences increment the counter in the database, never
+    read-modify-written in Python, so concurrent workers can not hand out the
+    same number. The row lock lasts until the enclosing transaction commits;
+    callers should allocate right before inserting the emissions that use
+    the numbers.
+
+    Hi-lo sequences reserve ``block_size`` numbers at once and serve them from
+    memory, only touching the sequence row when the block runs out.
+
+    Native sequences use a PostgreSQL SEQUENCE and take no row lock at all;
+    on other databases they behave as gapless sequences.
+
+    Args:
+        sequence (Sequence): The sequence to allocate from.
+        quantity (int): How many numbers to reserve.
+
+    Returns:
+        range | list: The reserved numbers, in ascending order. Only native
+        sequences may return non consecutive numbers.
+
+    Example:
+        >>> allocate(sequence, 3)
+        range(11, 14)
+    """
+    if quantity < 1:
+        raise ValueError("quantity must be a positive integer")
+    _record_rolled_back()
+    if sequence.allocation == Sequence.HILO:
+        return _allocate_from_block(sequence, quantity)
+    if sequence.pk in _blocks:
+        # The sequence left hi-lo allocation, the stale block is dropped
+        # after the commit. A rolled back caller keeps it, so its gap is
+        # recorded later instead of lost.
+        transaction.on_commit(
+            lambda: _drop_block(sequence.pk, "mode changed"),
+            using=Sequence.objects.db,
+        )
+    if _uses_native_sequence(sequence):
+        return _allocate_native(sequence, quantity)
+    return _increment(sequence.pk, quantity)
@@ -0,0 +1,150 @@
+import json
+import uuid
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .allocation import allocate
+from .batches import iter_batch_emissions
+from .idempotency import IdempotencyError, run_once
+from .membership import get_membership
+from .models import ApiToken, Emission, Sequence
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def authenticate_token(request):
+    """
+    Returns the user of the ``Authorization: Token <token>`` header, or None.
+    """
+    keyword, _, token = request.headers.get("Authorization", "").partition(" ")
+    if keyword != "Token" or not token:
+        return None
+    api_token = (
+        ApiToken.objects.select_related("user")
+        .filter(key=ApiToken.hash(token.strip()), user__is_active=True)
+        .first()
+    )
+    if api_token is None:
+        return None
+    ApiToken.objects.filter(pk=api_token.pk).update(last_used_at=timezone.now())
+    return api_token.user
+
+
+def parse_emission_requests(body):
+    try:
+        items = json.loads(body)["emissions"]
+    except (ValueError, KeyError, TypeError):
+        raise ApiError('Expected a JSON object with an "emissions" list')
+    if not isinstance(items, list) or not items:
+        raise ApiError('"emissions" must be a non empty list')
+    parsed = []
+    for index, item in enumerate(items):
+        try:
+            parsed.append(
+                {
+                    "sequence": uuid.UUID(str(item["sequence"])),
+                    "quantity": item.get("quantity", 1),
+                    "detail": str(item.get("detail", "")),
+                    "destination": str(item.get("destination", "N/A")),
+                }
+            )
+        except (KeyError, ValueError, TypeError, AttributeError):
+            raise ApiError(f"Invalid emission request at index {index}")
+        quantity = parsed[-1]["quantity"]
+        # Whole numbers only, 1.9 is not truncated and 1e400 is not a number
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            raise ApiError(f"Invalid quantity at index {index}")
+    if sum(item["quantity"] for item in parsed) > settings.EMISSION_BATCH_MAX_QUANTITY:
+        raise ApiError(
+            f"At most {settings.EMISSION_BATCH_MAX_QUANTITY} emissions per request"
+        )
+    return parsed
+
+
+def create_emissions(user, items):
+    """
+    Allocates the numbers of every request in a single transaction and
+    inserts the emissions.
+
+    Sequences are allocated in primary key order, so two clients asking for
+    the same sequences always lock them in the same order and can not
+    deadlock each other.
+    """
+    quantities = Counter()
+    for item in items:
+        quantities[item["sequence"]] += item["quantity"]
+    sequences = Sequence.objects.filter(
+        pk__in=quantities,
+        can_emit=True,
+        department__in=get_membership(user).department_ids,
+    ).in_bulk()
+    missing = [str(pk) for pk in quantities if pk not in sequences]
+    if missing:
+        raise ApiError(f"No sequence available: {', '.join(missing)}", status=403)
+    results = []
+    with transaction.atomic():
+        numbers = {}
+        for pk in sorted(quantities):
+            numbers[pk] = iter(allocate(sequences[pk], quantities[pk]))
+        emissions = []
+        for item in items:
+            sequence = sequences[item["sequence"]]
+            item_numbers = [next(numbers[sequence.pk]) for _ in range(item["quantity"])]
+            if item["quantity"] == 1:
+                item_emissions = [
+                    Emission(
+                        sequence=sequence,
+                        user=user,
+                        detail=item["detail"],
+                        destination=item["destination"],
+                        number=item_numbers[0],
+                    )
+                ]
+            else:
+                item_emissions = list(
+                    iter_batch_emissions(
+                        sequence,
+                        item_numbers,
+                        user,
+                        item["detail"],
+                        item["destination"],
+                        uuid.uuid4(),
+                    )
+                )
+            emissions.extend(item_emissions)
+            results.append(
+                {
+                    "sequence": str(sequence.pk),
+                    "batch": str(item_emissions[0].batch) if item_emissions[0].batch else None,
+                    "numbers": item_numbers,
+                    "ids": [str(emission.id) for emission in item_emissions],
+                }
+            )
+        Emission.objects.bulk_create(
+            emissions, batch_size=settings.EMISSION_BATCH_CHUNK_SIZE
+        )
+    return results
+
+
+@csrf_exempt
+@require_POST
+def emissions(request):
+    user = authenticate_token(request)
+    if user is None:
+        return JsonResponse({"error": "Invalid or missing token"}, status=401)
+    try:
+        items = parse_emission_requests(request.body)
+        result = run_once(
+            request, user, lambda: {"emissions": create_emissions(user, items)}
+        )
+    except (ApiError, IdempotencyError) as error:
+        return JsonResponse({"error": str(error)}, status=error.status)
+    return JsonResponse(result, status=201)
@@ -0,0 +1,126 @@
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+CHUNK_SIZE = 64 * 1024
+
+# Formats that are compressed already, deflating them again costs CPU and
+# saves nothing
+STORED_EXTENSIONS = {
+    ".7z",
+    ".docx",
+    ".gif",
+    ".gz",
+    ".jpeg",
+    ".jpg",
+    ".mp3",
+    ".mp4",
+    ".odt",
+    ".ods",
+    ".pdf",
+    ".png",
+    ".pptx",
+    ".rar",
+    ".webp",
+    ".xlsx",
+    ".zip",
+}
+
+
+class _Output:
+    """
+    Write end of the archive, emptied after every write so the archive is
+    never held in memory. It can not seek, zipfile then writes the sizes
+    and checksums of each entry after its data.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def entry_names(emission_files, folder=None):
+    """
+    Returns ``(name, emission_file)`` pairs with a unique name inside the
+    archive for each file, in a folder per emission when ``folder`` returns
+    one.
+    """
+    used = set()
+    entries = []
+    for emission_file in emission_files:
+        filename = emission_file.filename or os.path.basename(emission_file.file.name)
+        if folder:
+            filename = f"{folder(emission_file)}/{filename}"
+        root, extension = os.path.splitext(filename)
+        name, copy = filename, 1
+        while name in used:
+            copy += 1
+            name = f"{root} ({copy}){extension}"
+        used.add(name)
+        entries.append((name, emission_file))
+    return entries
+
+
+def emission_folder(emission_file):
+    """
+    Returns the folder of ``emission_file`` in a batch archive, named after
+    the document and the number of its emission.
+    """
+    emission = emission_file.emission
+    document = emission.sequence.document.name.replace("/", "-")
+    return f"{document} {emission.number}"
+
+
+def stream_zip(entries):
+    """
+    Yields a ZIP archive of ``entries``, ``(name, emission_file)`` pairs,
+    as it is built: each file is read and sent in chunks, so the first
+    bytes leave before the last file is opened.
+    """
+    output = _Output()
+    with zipfile.ZipFile(output, mode="w") as archive:
+        for name, emission_file in entries:
+            fieldfile = emission_file.file
+            try:
+                size = fieldfile.size
+            except FileNotFoundError:
+                continue
+            info = zipfile.ZipInfo(
+                name, timezone.localtime(emission_file.created_at).timetuple()[:6]
+            )
+            info.file_size = size
+            info.compress_type = (
+                zipfile.ZIP_STORED
+                if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+                else zipfile.ZIP_DEFLATED
+            )
+            with fieldfile.open("rb") as source, archive.open(info, "w") as target:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    target.write(chunk)
+                    data = output.drain()
+                    if data:
+                        yield data
+            yield output.drain()
+    yield output.drain()
+
+
+def zip_response(entries, filename):
+    response = StreamingHttpResponse(
+        stream_zip(entries), content_type="application/zip"
+    )
+    response["Content-Disposition"] = content_disposition_header(True, filename)
+    return response
@@ -0,0 +1,145 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, Max, Window
+from django.db.models.functions import Lag
+
+from .allocation import refresh_native_mirrors, sync_native_sequence
+from .models import Emission, Reservation, Sequence, SequenceGap
+
+
+def _subtract(ranges, holes):
+    """
+    Removes the ``holes`` ranges from ``ranges``, both sorted lists of
+    inclusive ``(start, end)`` tuples.
+    """
+    result = []
+    for start, end in ranges:
+        for hole_start, hole_end in holes:
+            if hole_end < start or hole_start > end:
+                continue
+            if hole_start > start:
+                result.append((start, hole_start - 1))
+            start = hole_end + 1
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return result
+
+
+def _merge(numbers):
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], number)
+        else:
+            ranges.append((number, number))
+    return ranges
+
+
+def audit(sequences):
+    """
+    Checks the emission numbers of the given sequences.
+
+    Every check is a set based query over the ``(sequence, number)`` index:
+    a LAG window function finds the holes between consecutive numbers, a
+    grouped count finds duplicated numbers and a grouped max gives the drift
+    between the counter and the highest emitted number. Soft deleted
+    emissions still count, their numbers were handed out. Holes recorded in
+    the gap ledger or held by reservations are reported as explained.
+
+    Args:
+        sequences (QuerySet): The sequences to audit.
+
+    Returns:
+        list: One dict per sequence with ``emissions``, ``max_number``,
+        ``drift`` (counter minus the highest number), ``duplicates``
+        (``(number, count)`` tuples), ``gaps`` and ``unexplained_gaps``
+        (inclusive ``(start, end)`` tuples).
+    """
+    sequences = list(sequences)
+    refresh_native_mirrors(sequences)
+    emissions = Emission.all_objects.filter(sequence__in=sequences)
+
+    totals = {
+        row["sequence_id"]: row
+        for row in emissions.values("sequence_id").annotate(
+            emissions=Count("id"), max_number=Max("number")
+        )
+    }
+    duplicates = defaultdict(list)
+    for sequence_id, number, count in (
+        emissions.values("sequence_id", "number")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .order_by("sequence_id", "number")
+        .values_list("sequence_id", "number", "count")
+    ):
+        duplicates[sequence_id].append((number, count))
+    gaps = defaultdict(list)
+    for sequence_id, previous, number in (
+        emissions.annotate(
+            previous=Window(
+                Lag("number"),
+                partition_by=[F("sequence_id")],
+                order_by=F("number").asc(),
+            )
+        )
+        .filter(number__gt=F("previous") + 1)
+        .values_list("sequence_id", "previous", "number")
+    ):
+        gaps[sequence_id].append((previous + 1, number - 1))
+    explained = defaultdict(list)
+    for sequence_id, start, end in SequenceGap.objects.filter(
+        sequence__in=sequences
+    ).values_list("sequence_id", "start", "end"):
+        explained[sequence_id].append((start, end))
+    reserved = defaultdict(list)
+    for sequence_id, number in Reservation.objects.filter(
+        sequence__in=sequences,
+        status__in=[Reservation.RESERVED, Reservation.EXPIRED],
+    ).values_list("sequence_id", "number"):
+        reserved[sequence_id].append(number)
+
+    report = []
+    for sequence in sequences:
+        total = totals.get(sequence.pk, {"emissions": 0, "max_number": None})
+        max_number = total["max_number"]
+        drift = sequence.sequence - max_number if max_number is not None else 0
+        sequence_gaps = sorted(gaps[sequence.pk])
+        if max_number is not None and sequence.sequence > max_number:
+            # Numbers handed out by the counter but never emitted.
+            sequence_gaps.append((max_number + 1, sequence.sequence))
+        holes = sorted(explained[sequence.pk] + _merge(reserved[sequence.pk]))
+        report.append(
+            {
+                "sequence": sequence,
+                "emissions": total["emissions"],
+                "max_number": max_number,
+                "drift": drift,
+                "duplicates": duplicates[sequence.pk],
+                "gaps": sequence_gaps,
+                "unexplained_gaps": _subtract(sequence_gaps, holes),
+            }
+        )
+    return report
+
+
+def repair(report):
+    """
+    Moves counters that fell behind their highest emitted number forward, so
+    they can not hand out an existing number again. Duplicates and gaps are
+    left for a person to review. Returns the repaired sequences.
+    """
+    repaired = []
+    for row in report:
+        sequence = row["sequence"]
+        if row["drift"] >= 0:
+            continue
+        Sequence.objects.filter(
+            pk=sequence.pk, sequence__lt=row["max_number"]
+        ).update(sequence=row["max_number"])
+        sequence.sequence = row["max_number"]
+        sync_native_sequence(sequence)
+        repaired.append(sequence)
+    return repaired
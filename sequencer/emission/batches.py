@@ -0,0 +1,80 @@
+import uuid
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from .allocation import allocate, record_gap
+from .models import Emission
+
+
+class BatchFailed(Exception):
+    """
+    Raised when a chunk fails after others were committed, the emissions
+    already created in ``batch`` are kept.
+    """
+
+    def __init__(self, batch, created):
+        super().__init__(f"Batch {batch} failed after {created} emissions")
+        self.batch = batch
+        self.created = created
+
+
+def iter_batch_emissions(sequence, numbers, user, detail, destination, batch):
+    quantity = len(numbers)
+    for i, number in enumerate(numbers, start=1):
+        yield Emission(
+            sequence=sequence,
+            detail=f"{i}/{quantity}: {detail} ({batch})",
+            destination=destination,
+            user=user,
+            number=number,
+            batch=batch,
+        )
+
+
+def create_batch(sequence, quantity, user, detail, destination, progress=None):
+    """
+    Creates ``quantity`` emissions sharing a new batch id.
+
+    The numbers are reserved up front in one short transaction, so the
+    sequence is locked only for the reservation. Emissions are then built
+    lazily and inserted in chunks of ``EMISSION_BATCH_CHUNK_SIZE``, each in
+    its own transaction, keeping memory constant whatever the quantity.
+
+    Args:
+        sequence (Sequence): The sequence to emit from.
+        quantity (int): Number of emissions to create.
+        user (CustomUser): Owner of the emissions.
+        detail (str): Detail shared by the emissions.
+        destination (str): Destination shared by the emissions.
+        progress (callable): Called as ``progress(created, quantity)`` after
+            every chunk.
+
+    Returns:
+        UUID: The batch id.
+
+    Raises:
+        BatchFailed: A chunk failed after others were committed.
+    """
+    batch = uuid.uuid4()
+    numbers = allocate(sequence, quantity)
+    emissions = iter_batch_emissions(
+        sequence, numbers, user, detail, destination, batch
+    )
+    chunk_size = settings.EMISSION_BATCH_CHUNK_SIZE
+    created = 0
+    try:
+        while chunk := list(islice(emissions, chunk_size)):
+            with transaction.atomic():
+                Emission.objects.bulk_create(chunk, batch_size=chunk_size)
+            created += len(chunk)
+            if progress:
+                progress(created, quantity)
+    except Exception as error:
+        # The reservation is committed, keep the unused numbers accounted for.
+        record_gap(sequence.pk, numbers[created:], "batch failed")
+        if created:
+            raise BatchFailed(batch, created) from error
+        raise
+    return batch
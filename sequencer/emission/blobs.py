@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.urls import reverse
+
+from .models import Blob, EmissionFile
+
+
+def sha256(content):
+    """
+    Returns the hexadecimal sha256 of ``content``, a Django ``File`` read
+    once in chunks.
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_name(checksum):
+    return f"blobs/{checksum[:2]}/{checksum}"
+
+
+def attach_blob(emission_file, content, filename=None, checksum=None):
+    """
+    Points ``emission_file`` at the blob holding ``content`` and saves it.
+
+    Content already stored by another file is not written again, the new
+    file only adds a reference to its blob. ``checksum`` skips hashing
+    when the caller already verified the sha256 of the content.
+    """
+    if checksum is None:
+        checksum = sha256(content)
+    with transaction.atomic():
+        # waits for a running collect_blobs, which may be removing it
+        blob = Blob.all_objects.select_for_update().filter(sha256=checksum).first()
+        if blob is None:
+            name = default_storage.save(blob_name(checksum), content)
+            blob, created = Blob.all_objects.get_or_create(
+                sha256=checksum, defaults={"file": name, "size": content.size}
+            )
+            if not created:
+                # another request stored the same content first
+                default_storage.delete(name)
+        emission_file.blob = blob
+        emission_file.file = blob.file.name
+        emission_file.filename = os.path.basename(filename or content.name)
+        # the media URL of the blob would skip the permission checks
+        emission_file.url = reverse(
+            "emissions:download_file",
+            args=[emission_file.emission_id, emission_file.pk],
+        )
+        emission_file.save()
+    return emission_file
+
+
+def collect_blobs():
+    """
+    Removes the blobs no emission file points to, with their content,
+    returning how many. Soft deleted files keep their blob, so restoring
+    one never points at removed content.
+    """
+    with transaction.atomic():
+        blobs = list(
+            Blob.all_objects.select_for_update()
+            .filter(references=0)
+            .exclude(Exists(EmissionFile.all_objects.filter(blob=OuterRef("pk"))))
+        )
+        names = [blob.file.name for blob in blobs]
+        Blob.all_objects.filter(pk__in=[blob.pk for blob in blobs]).delete()
+        transaction.on_commit(lambda: _delete_content(names))
+    return len(blobs)
+
+
+def _delete_content(names):
+    for name in names:
+        default_storage.delete(name)
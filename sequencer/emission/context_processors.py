@@ -1,17 +1,11 @@
-from .models import GlobalSettings, UserDepartment
+from .global_settings import get_global_settings
+from .membership import get_membership
 
 
 def has_permission(request):
-    can_administrate = False
-    if request.user.is_authenticated:
-        user_department = UserDepartment.objects.filter(
-            user=request.user, can_administrate=True
-        )
-        if user_department:
-            can_administrate = True
-    return {"can_administrate": can_administrate}
+    return {"can_administrate": get_membership(request.user).is_admin()}
 
 
 def global_settings(request):
-    settings = GlobalSettings.objects.first()
+    settings = get_global_settings(request)
     return {"global_settings": settings}
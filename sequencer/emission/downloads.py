@@ -0,0 +1,113 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import (
+    content_disposition_header,
+    http_date,
+    parse_http_date_safe,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+_byte_range = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_response(request, emission_file):
+    """
+    Returns the attachment of ``emission_file`` as a download, call it once
+    the permissions are checked.
+
+    With ``EMISSION_ACCEL_REDIRECT_PREFIX`` set the response is empty and
+    nginx sends the file from its internal location, otherwise it is
+    streamed from the storage in chunks. Conditional requests are answered
+    with 304 and a single byte range with 206, so a repeated or resumed
+    download only moves the bytes the client is missing.
+    """
+    fieldfile = emission_file.file
+    filename = emission_file.filename or os.path.basename(fieldfile.name)
+    size, last_modified = _metadata(fieldfile)
+    # Same format as the ETags of nginx, they do not change when it serves
+    # the file instead of Django
+    etag = f'"{last_modified:x}-{size:x}"'
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        prefix = settings.EMISSION_ACCEL_REDIRECT_PREFIX
+        if prefix:
+            response = HttpResponse(content_type=content_type)
+            response["X-Accel-Redirect"] = quote(prefix + fieldfile.name)
+        else:
+            response = _partial_response(
+                request, fieldfile, size, etag, last_modified, content_type
+            )
+            if response is None:
+                response = FileResponse(fieldfile.open("rb"))
+                response["Content-Type"] = content_type
+            response["Accept-Ranges"] = "bytes"
+        response["Content-Disposition"] = content_disposition_header(True, filename)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _metadata(fieldfile):
+    try:
+        size = fieldfile.storage.size(fieldfile.name)
+        modified = fieldfile.storage.get_modified_time(fieldfile.name)
+    except FileNotFoundError:
+        raise Http404("No such file")
+    return size, int(modified.timestamp())
+
+
+def _partial_response(request, fieldfile, size, etag, last_modified, content_type):
+    """
+    Returns the response to the ``Range`` header of ``request``, or None to
+    send the whole file. Only single ranges are served, a client asking for
+    several of them gets the whole file as the RFC allows.
+    """
+    match = _byte_range.match(request.headers.get("Range", "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    if_range = request.headers.get("If-Range")
+    if (
+        if_range
+        and if_range != etag
+        and parse_http_date_safe(if_range) != last_modified
+    ):
+        # the file changed since the client got its first part
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size or end < start:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    response = StreamingHttpResponse(
+        _read(fieldfile, start, end - start + 1), status=206, content_type=content_type
+    )
+    response["Content-Length"] = str(end - start + 1)
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def _read(fieldfile, start, length):
+    with fieldfile.open("rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
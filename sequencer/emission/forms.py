@@ -1,6 +1,10 @@
 from django import forms
+from django.conf import settings
+from django.core.validators import MaxValueValidator
 from django.db import transaction
 
+from .allocation import allocate, sync_native_sequence
+from .membership import get_membership
 from .widgets import (
     BulmaFileWidget,
     BulmaNumberWidget,
@@ -15,12 +19,19 @@ from .models import (
     Document,
     Emission,
     EmissionFile,
+    Reservation,
     UserDepartment,
     Sequence,
     Year,
 )
 
 
+def limit_batch_quantity(field):
+    field.max_value = settings.EMISSION_BATCH_MAX_QUANTITY
+    field.validators.append(MaxValueValidator(field.max_value))
+    field.widget.attrs["max"] = field.max_value
+
+
 class EmissionForm(forms.ModelForm):
     class Meta:
         model = Emission
@@ -30,21 +41,19 @@ class EmissionForm(forms.ModelForm):
         self.user = kwargs.pop("user", None)
         super().__init__(*args, **kwargs)
         if self.user:
-            user_departments = UserDepartment.objects.filter(user=self.user)
             self.fields["sequence"].queryset = Sequence.objects.filter(
-                department__in=user_departments.values_list("department", flat=True),
+                department__in=get_membership(self.user).department_ids,
                 can_emit=True,
             )
             self.fields["sequence"].widget = BulmaSelectWidget()
 
     def save(self, commit=True):
         instance = super().save(commit=False)
-        sequence = Sequence.objects.get(id=instance.sequence.id)
-        sequence.increment()
-        instance.number = sequence.sequence
         instance.user = self.user
-        if commit:
-            instance.save()
+        with transaction.atomic():
+            instance.number = allocate(instance.sequence)[0]
+            if commit:
+                instance.save()
         return instance
 
 
@@ -58,23 +67,22 @@ class EmissionByDepartmentForm(forms.ModelForm):
         self.department = kwargs.pop("department", None)
         super().__init__(*args, **kwargs)
         if self.user:
-            user_departments = UserDepartment.objects.filter(user=self.user)
             self.fields["detail"].widget = BulmaTextWidget()
             self.fields["sequence"].widget = BulmaSelectWidget()
             self.fields["destination"].widget = BulmaTextLineWidget()
             self.fields["sequence"].queryset = Sequence.objects.filter(
-                department__in=user_departments.values_list("department", flat=True),
+                department__in=get_membership(self.user).department_ids,
                 can_emit=True,
                 department=self.department,
             )
 
     def save(self, commit=True):
         instance = super().save(commit=False)
-        sequence = Sequence.objects.get(pk=instance.sequence.pk)
-        instance.number = sequence.increment()
         instance.user = self.user
-        if commit:
-            instance.save()
+        with transaction.atomic():
+            instance.number = allocate(instance.sequence)[0]
+            if commit:
+                instance.save()
         return instance
 
 
@@ -92,9 +100,8 @@ class EmissionByDepartmentFormEdit(forms.ModelForm):
         self.fields["destination"].widget = BulmaTextLineWidget()
         self.fields["sequence"].disabled = True
         if self.user:
-            user_departments = UserDepartment.objects.filter(user=self.user)
             self.fields["sequence"].queryset = Sequence.objects.filter(
-                department__in=user_departments.values_list("department", flat=True),
+                department__in=get_membership(self.user).department_ids,
                 can_emit=True,
                 department=self.department,
             )
@@ -118,18 +125,50 @@ class EmissionByDepartmentBatchForm(forms.ModelForm):
         self.user = kwargs.pop("user", None)
         self.department = kwargs.pop("department", None)
         super().__init__(*args, **kwargs)
+        limit_batch_quantity(self.fields["quantity"])
         self.fields["detail"].widget = BulmaTextWidget()
         self.fields["sequence"].widget = BulmaSelectWidget()
         self.fields["destination"].widget = BulmaTextLineWidget()
         if self.user:
-            user_departments = UserDepartment.objects.filter(user=self.user)
             self.fields["sequence"].queryset = Sequence.objects.filter(
-                department__in=user_departments.values_list("department", flat=True),
+                department__in=get_membership(self.user).department_ids,
+                can_emit=True,
+                department=self.department,
+            )
+
+
+class ReservationForm(forms.ModelForm):
+    quantity = forms.IntegerField(min_value=1, initial=1, widget=BulmaNumberWidget)
+
+    class Meta:
+        model = Reservation
+        fields = ["sequence"]
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop("user", None)
+        self.department = kwargs.pop("department", None)
+        super().__init__(*args, **kwargs)
+        limit_batch_quantity(self.fields["quantity"])
+        self.fields["sequence"].widget = BulmaSelectWidget()
+        if self.user:
+            self.fields["sequence"].queryset = Sequence.objects.filter(
+                department__in=get_membership(self.user).department_ids,
                 can_emit=True,
                 department=self.department,
             )
 
 
+class ReservationConfirmForm(forms.ModelForm):
+    class Meta:
+        model = Emission
+        fields = ["detail", "destination"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["detail"].widget = BulmaTextWidget()
+        self.fields["destination"].widget = BulmaTextLineWidget()
+
+
 class AdminEmissionByDepartmentForm(forms.ModelForm):
     class Meta:
         model = Emission
@@ -152,10 +191,10 @@ class AdminEmissionByDepartmentForm(forms.ModelForm):
 
     def save(self, commit=True):
         instance = super().save(commit=False)
-        sequence = Sequence.objects.get(pk=instance.sequence.pk)
-        instance.number = sequence.increment()
-        if commit:
-            instance.save()
+        with transaction.atomic():
+            instance.number = allocate(instance.sequence)[0]
+            if commit:
+                instance.save()
         return instance
 
 
@@ -169,6 +208,7 @@ class AdminEmissionByDepartmentBatchForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         self.department = kwargs.pop("department", None)
         super().__init__(*args, **kwargs)
+        limit_batch_quantity(self.fields["quantity"])
         self.fields["user"].widget = BulmaSelectWidget()
         self.fields["sequence"].widget = BulmaSelectWidget()
         self.fields["detail"].widget = BulmaTextWidget()
@@ -264,7 +304,7 @@ class UserDepartmentForm(forms.ModelForm):
 class SequenceForm(forms.ModelForm):
     class Meta:
         model = Sequence
-        fields = ["document", "year", "sequence", "can_emit"]
+        fields = ["document", "year", "sequence", "can_emit", "allocation", "block_size"]
 
     def __init__(self, *args, **kwargs):
         self.department = kwargs.pop("department", None)
@@ -275,6 +315,9 @@ class SequenceForm(forms.ModelForm):
         self.fields["sequence"].initial = 0
         self.fields["can_emit"].widget = BulmaSwitchWidget()
         self.fields["can_emit"].label = ""
+        self.fields["allocation"].widget = BulmaSelectWidget()
+        self.fields["allocation"].widget.choices = self.fields["allocation"].choices
+        self.fields["block_size"].widget = BulmaNumberWidget()
         self.fields["document"].queryset = Document.objects.all()
         self.fields["year"].queryset = Year.objects.all()
 
@@ -293,4 +336,5 @@ class SequenceForm(forms.ModelForm):
         instance.department = self.department
         if commit:
             instance.save()
+            sync_native_sequence(instance)
         return instance
@@ -0,0 +1,54 @@
+import uuid
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+from .models import GlobalSettings
+
+VERSION_KEY = "emission:global_settings:version"
+
+# (version, settings) read by this process
+_cached = (None, None)
+
+
+def get_global_settings(request=None):
+    """
+    Returns the ``GlobalSettings`` row, read once per request and, with
+    ``EMISSION_SHARED_CACHE``, once per process and again only when another
+    process saved it.
+
+    The shared cache only keeps a version token, so every worker notices a
+    change with a cache read instead of a query. The token is random, an
+    evicted key is replaced by a new one and the workers read the row again
+    instead of trusting an old copy.
+
+    Args:
+        request (HttpRequest): Keeps the settings for the middleware and
+            the context processors of the same request.
+    """
+    if request is None:
+        return _read()
+    try:
+        return request._emission_global_settings
+    except AttributeError:
+        request._emission_global_settings = _read()
+        return request._emission_global_settings
+
+
+def _read():
+    global _cached
+    if not django_settings.EMISSION_SHARED_CACHE:
+        return GlobalSettings.objects.first()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    cached_version, settings = _cached
+    if version is None or version != cached_version:
+        settings = GlobalSettings.objects.first()
+        _cached = (version, settings)
+    return settings
+
+
+def invalidate():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .batches import BatchFailed
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+FIELD = "idempotency_key"
+FORM_CONTENT_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+class IdempotencyError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def get_key(request):
+    return (request.headers.get(HEADER) or request.POST.get(FIELD) or "")[:255]
+
+
+def fingerprint(request):
+    """
+    Returns the sha256 of the payload of ``request``. Forms are hashed by
+    their fields, without the CSRF token and the key itself.
+    """
+    if request.content_type in FORM_CONTENT_TYPES:
+        fields = sorted(
+            (name, value)
+            for name, values in request.POST.lists()
+            if name not in ("csrfmiddlewaretoken", FIELD)
+            for value in values
+        )
+        payload = json.dumps(fields).encode()
+    else:
+        payload = request.body
+    return hashlib.sha256(payload).hexdigest()
+
+
+def run_once(request, user, action):
+    """
+    Runs ``action`` once per user and idempotency key.
+
+    The key is claimed in its own transaction before ``action`` runs, so a
+    retried request never reaches the sequence: it gets the stored result of
+    the first request. Without a key ``action`` simply runs.
+
+    The key is bound to the path and the payload of the first request. It
+    can not be reused for another request, nor retried once a batch failed
+    after committing part of its emissions. Keys older than
+    ``EMISSION_IDEMPOTENCY_TTL`` seconds are free again.
+
+    Args:
+        request (HttpRequest): The request, its key comes from get_key().
+        user (CustomUser): The user sending the request.
+        action (callable): Creates the emissions and returns a JSON
+            serializable result.
+
+    Returns:
+        The result of ``action`` or the stored result of the first request.
+
+    Raises:
+        IdempotencyError: With status 409 while the first request is still
+            running or just gave the key back, 422 when the key belongs to
+            another request or to a failed batch.
+    """
+    key = get_key(request)
+    if not key:
+        return action()
+    path = request.path[:255]
+    payload = fingerprint(request)
+    try:
+        with transaction.atomic():
+            # an expired key is not replayed, even if no cron purged it
+            IdempotencyKey.all_objects.filter(
+                user=user, key=key, created_at__lt=_cutoff()
+            ).delete()
+            claim = IdempotencyKey.objects.create(
+                user=user, key=key, path=path, fingerprint=payload
+            )
+    except IntegrityError:
+        previous = IdempotencyKey.all_objects.filter(user=user, key=key).first()
+        if previous is None:
+            # the first request failed and gave the key back meanwhile
+            raise IdempotencyError(
+                "A request with this idempotency key just failed, send it again",
+                status=409,
+            )
+        if (previous.path, previous.fingerprint) != (path, payload):
+            raise IdempotencyError(
+                "This idempotency key was used for another request", status=422
+            )
+        if previous.status == IdempotencyKey.RUNNING:
+            raise IdempotencyError(
+                "A request with this idempotency key is still running", status=409
+            )
+        if previous.status == IdempotencyKey.FAILED:
+            raise IdempotencyError(
+                "The request with this idempotency key failed after creating "
+                "some emissions, check them before sending it again",
+                status=422,
+            )
+        return previous.result
+    claimed = IdempotencyKey.all_objects.filter(pk=claim.pk)
+    try:
+        result = action()
+    except BatchFailed as error:
+        # Part of the batch is committed, a retry must not emit it again.
+        claimed.update(
+            status=IdempotencyKey.FAILED,
+            result={"batch": str(error.batch), "created": error.created},
+        )
+        raise
+    except Exception:
+        # Nothing was committed, let the client retry with the same key.
+        claimed.delete()
+        raise
+    claimed.update(status=IdempotencyKey.DONE, result=result)
+    return result
+
+
+def expire_keys():
+    """
+    Deletes the keys older than ``EMISSION_IDEMPOTENCY_TTL`` seconds,
+    returning how many.
+    """
+    deleted, _ = IdempotencyKey.all_objects.filter(created_at__lt=_cutoff()).delete()
+    return deleted
+
+
+def _cutoff():
+    return timezone.now() - timedelta(seconds=settings.EMISSION_IDEMPOTENCY_TTL)
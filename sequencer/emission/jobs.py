@@ -0,0 +1,139 @@
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .batches import create_batch
+from .models import CustomUser, Job, Sequence
+
+# Job kind -> function running it, see register().
+handlers = {}
+
+
+def register(kind):
+    """
+    Registers the decorated function as the handler of a job kind.
+
+    The handler is called as ``handler(job, progress, **job.payload)`` and
+    returns a JSON serializable result stored in ``job.result``.
+    """
+
+    def decorator(function):
+        handlers[kind] = function
+        return function
+
+    return decorator
+
+
+def enqueue(kind, user, payload, total=0):
+    if kind not in handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return Job.objects.create(kind=kind, user=user, total=total, payload=payload)
+
+
+def fail_expired(jobs=None):
+    """
+    Fails the running jobs whose worker gave no sign of life for
+    ``EMISSION_JOB_LEASE`` seconds, it crashed or was restarted. They are
+    not run again: a batch commits its chunks as it goes, running it twice
+    would emit its numbers twice. Returns how many jobs failed.
+    """
+    now = timezone.now()
+    jobs = Job.objects.all() if jobs is None else jobs
+    return jobs.filter(
+        status=Job.RUNNING,
+        heartbeat_at__lt=now - timedelta(seconds=settings.EMISSION_JOB_LEASE),
+    ).update(
+        status=Job.FAILED,
+        error="The worker running the job stopped",
+        finished_at=now,
+    )
+
+
+def claim_next():
+    """
+    Marks the oldest pending job as running and returns it, or None.
+
+    The claim is a conditional UPDATE, so several workers can poll the same
+    table without ever running a job twice, on any database.
+    """
+    fail_expired()
+    pending = Job.objects.filter(status=Job.PENDING).order_by("created_at")
+    for pk in pending.values_list("pk", flat=True)[:10]:
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=pk, status=Job.PENDING).update(
+            status=Job.RUNNING, started_at=now, heartbeat_at=now
+        )
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def heartbeat(job):
+    """
+    Tells the other workers the job is still running. Returns False once it
+    was failed by fail_expired(), its lease is lost.
+    """
+    return bool(
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+            heartbeat_at=timezone.now()
+        )
+    )
+
+
+def _keep_alive(job, stop):
+    # Beats well within the lease, a single slow chunk between two progress
+    # reports must not look like a dead worker.
+    try:
+        while not stop.wait(settings.EMISSION_JOB_LEASE / 3):
+            if not heartbeat(job):
+                return
+    finally:
+        connections.close_all()
+
+
+def run(job):
+    """
+    Runs a claimed job and stores its outcome. The outcome is only written
+    while the job is still running: a job failed by fail_expired() keeps
+    that single outcome.
+    """
+
+    def progress(done, total):
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+            progress=done, total=total, heartbeat_at=timezone.now()
+        )
+
+    stop = threading.Event()
+    beating = threading.Thread(target=_keep_alive, args=(job, stop), daemon=True)
+    beating.start()
+    try:
+        result = handlers[job.kind](job, progress, **job.payload)
+    except Exception:
+        outcome = {"status": Job.FAILED, "error": traceback.format_exc()}
+    else:
+        outcome = {"status": Job.DONE, "result": result}
+    finally:
+        stop.set()
+        beating.join()
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+        finished_at=timezone.now(), **outcome
+    )
+    job.refresh_from_db()
+    return job
+
+
+@register("emission_batch")
+def emission_batch(job, progress, sequence, quantity, user, detail, destination):
+    batch = create_batch(
+        Sequence.objects.get(pk=sequence),
+        quantity,
+        user=CustomUser.objects.get(pk=user),
+        detail=detail,
+        destination=destination,
+        progress=progress,
+    )
+    return {"batch": str(batch)}
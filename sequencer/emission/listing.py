@@ -0,0 +1,204 @@
+import base64
+import binascii
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Count, F, Q
+
+
+class KeysetPage:
+    """
+    A page of a listing fetched after or before the ordering values of a
+    row, instead of at an OFFSET. Moving to the next or the previous page
+    costs the same at any depth.
+
+    Attributes:
+        object_list (list): The rows of the page.
+        count (int): Rows of the whole listing.
+        count_is_approximate (bool): Whether ``count`` is an estimate of the
+            query planner.
+        next_cursor (str): Query string value for the next page, or None.
+        previous_cursor (str): Query string value for the previous page, or
+            None.
+    """
+
+    def __init__(self, object_list, count, count_is_approximate=False):
+        self.object_list = object_list
+        self.count = count
+        self.count_is_approximate = count_is_approximate
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def _encode(direction, values):
+    data = json.dumps(values, cls=DjangoJSONEncoder).encode()
+    return direction + base64.urlsafe_b64encode(data).decode()
+
+
+def _decode(cursor, fields):
+    """
+    Returns the direction and the ordering values of a cursor, or None when
+    the cursor is not valid.
+    """
+    if not cursor:
+        return None
+    if cursor == "last":
+        return "p", None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor[1:].encode()))
+        if cursor[0] not in "np" or len(values) != len(fields):
+            return None
+        return cursor[0], [
+            field.to_python(value) for field, value in zip(fields, values)
+        ]
+    except (binascii.Error, ValueError, TypeError, ValidationError):
+        return None
+
+
+def _after(keys, values, descending):
+    """
+    Builds the condition selecting the rows placed after ``values`` in the
+    ordering of ``keys``.
+    """
+    condition = Q()
+    equal = Q()
+    for key, value, desc in zip(keys, values, descending):
+        lookup = f"{key}__lt" if desc else f"{key}__gt"
+        condition |= equal & Q(**{lookup: value})
+        equal &= Q(**{key: value})
+    return condition
+
+
+def approximate_count(queryset):
+    """
+    Estimates the rows of ``queryset`` from the statistics of the query
+    planner without running it. Only PostgreSQL gives an estimate, other
+    databases count the rows.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count(), False
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"], True
+
+
+def department_pages(
+    queryset, departments, request, ordering, department_field, per_page=12
+):
+    """
+    Paginates ``queryset`` separately for every department with keyset
+    pagination.
+
+    The page of a department starts after (or ends before) the ordering
+    values of the cursor given as ``cursor_<department id>`` in the query
+    string, so every page is a single indexed range scan with a LIMIT. The
+    pages of all the departments are read with one query. The primary key
+    is added to the ordering to break ties. The totals come
+    from one grouped COUNT, or from the query planner when
+    ``EMISSION_APPROXIMATE_COUNTS`` is enabled.
+
+    Args:
+        queryset (QuerySet): Rows of all the departments.
+        departments (list): The departments, one page each.
+        request (HttpRequest): The request with the cursors.
+        ordering (list): Field names ordering the rows of a department.
+        department_field (str): Lookup from a row to its department.
+        per_page (int): Rows per page.
+
+    Returns:
+        dict: ``KeysetPage`` by department id.
+    """
+    if not departments:
+        return {}
+    ordering = list(ordering) + ["pk"]
+    keys = [f"keyset_{index}" for index in range(len(ordering))]
+    descending = [field.startswith("-") for field in ordering]
+    queryset = queryset.annotate(
+        **{key: F(field.lstrip("-")) for key, field in zip(keys, ordering)}
+    )
+    fields = [queryset.query.annotations[key].output_field for key in keys]
+    forward = [f"-{key}" if desc else key for key, desc in zip(keys, descending)]
+    backward = [key if desc else f"-{key}" for key, desc in zip(keys, descending)]
+
+    if settings.EMISSION_APPROXIMATE_COUNTS:
+        counts = {}
+        for department in departments:
+            counts[department.id] = approximate_count(
+                queryset.filter(**{department_field: department.id})
+            )
+    else:
+        counts = {
+            department_id: (total, False)
+            for department_id, total in queryset.order_by()
+            .values_list(department_field)
+            .annotate(total=Count("pk"))
+        }
+
+    # The page of every department is a sliced subquery, all of them are
+    # read by a single query.
+    connection = connections[queryset.db]
+    directions = {}
+    condition = Q()
+    for department in departments:
+        rows = queryset.filter(**{department_field: department.id})
+        cursor = _decode(request.GET.get(f"cursor_{department.id}", ""), fields)
+        direction, values = cursor if cursor else ("n", None)
+        backwards = direction == "p"
+        if values is not None:
+            # Rows before the cursor are the rows after it in reverse order.
+            rows = rows.filter(
+                _after(keys, values, [desc != backwards for desc in descending])
+            )
+        rows = rows.order_by(*(backward if backwards else forward))
+        rows = rows.values("pk")[: per_page + 1]
+        if not connection.features.allow_sliced_subqueries_with_in:
+            rows = list(rows)
+        condition |= Q(pk__in=rows)
+        directions[department.id] = (backwards, values)
+    rows_by_department = defaultdict(list)
+    for row in queryset.annotate(keyset_department=F(department_field)).filter(
+        condition
+    ).order_by(*forward):
+        rows_by_department[row.keyset_department].append(row)
+
+    pages = {}
+    for department in departments:
+        backwards, values = directions[department.id]
+        rows = rows_by_department[department.id]
+        more = len(rows) > per_page
+        # The extra row tells whether there is a page beyond this one.
+        rows = rows[-per_page:] if backwards else rows[:per_page]
+        page = KeysetPage(rows, *counts.get(department.id, (0, False)))
+        if rows:
+            has_previous, has_next = (more, values is not None)
+            if not backwards:
+                has_previous, has_next = (values is not None, more)
+            first = [getattr(rows[0], key) for key in keys]
+            last = [getattr(rows[-1], key) for key in keys]
+            if has_previous:
+                page.previous_cursor = _encode("p", first)
+            if has_next:
+                page.next_cursor = _encode("n", last)
+        pages[department.id] = page
+    return pages
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from emission.audit import audit, repair
+from emission.models import Sequence
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports gaps, duplicated numbers and counter drift of the emission "
+        "sequences, optionally moving counters that fell behind forward."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sequence", action="append", help="Sequence id, repeat for several."
+        )
+        parser.add_argument(
+            "--department", action="append", help="Department id, repeat for several."
+        )
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="Move counters behind their highest emitted number forward.",
+        )
+
+    def handle(self, *args, **options):
+        sequences = Sequence.objects.select_related("department", "document", "year")
+        if options["sequence"]:
+            sequences = sequences.filter(pk__in=options["sequence"])
+        if options["department"]:
+            sequences = sequences.filter(department__in=options["department"])
+        report = audit(sequences.order_by("department__name", "year__year"))
+        problems = 0
+        for row in report:
+            failed = row["duplicates"] or row["unexplained_gaps"] or row["drift"] < 0
+            problems += bool(failed)
+            style = self.style.ERROR if failed else self.style.SUCCESS
+            self.stdout.write(style(f"{row['sequence']} ({row['sequence'].pk})"))
+            self.stdout.write(
+                f"  emissions: {row['emissions']}, highest number: {row['max_number']}, "
+                f"counter drift: {row['drift']}"
+            )
+            if row["duplicates"]:
+                self.stdout.write(
+                    "  duplicates: "
+                    + ", ".join(f"{number} x{count}" for number, count in row["duplicates"][:50])
+                )
+            if row["gaps"]:
+                self.stdout.write(
+                    f"  gaps: {len(row['gaps'])}, unexplained: "
+                    + (
+                        ", ".join(f"{start}-{end}" for start, end in row["unexplained_gaps"][:50])
+                        or "none"
+                    )
+                )
+        if options["repair"]:
+            for sequence in repair(report):
+                self.stdout.write(
+                    self.style.WARNING(f"Counter of {sequence.pk} moved to {sequence.sequence}")
+                )
+        self.stdout.write(f"{len(report)} sequences audited, {problems} with problems")
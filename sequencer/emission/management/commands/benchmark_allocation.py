@@ -0,0 +1,260 @@
+import multiprocessing
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+
+from emission.allocation import (
+    allocate,
+    drop_native_sequence,
+    refresh_native_mirrors,
+    release_blocks,
+)
+from emission.api import create_emissions
+from emission.batches import create_batch
+from emission.forms import EmissionByDepartmentForm
+from emission.models import (
+    CustomUser,
+    Department,
+    Document,
+    Emission,
+    Sequence,
+    SequenceGap,
+    UserDepartment,
+    Year,
+)
+
+PATHS = ["allocator", "form", "batch", "api"]
+
+
+def _operation(path, sequence, user, batch_size):
+    """
+    Returns a callable running one operation of ``path`` and returning the
+    numbers it obtained.
+    """
+    if path == "allocator":
+        return lambda: list(allocate(sequence))
+    if path == "form":
+
+        def emit():
+            form = EmissionByDepartmentForm(
+                {"sequence": sequence.pk, "detail": "benchmark", "destination": "-"},
+                user=user,
+                department=sequence.department,
+            )
+            if not form.is_valid():
+                raise ValueError(form.errors.as_text())
+            return [form.save().number]
+
+        return emit
+    if path == "batch":
+
+        def emit():
+            batch = create_batch(sequence, batch_size, user, "benchmark", "-")
+            return list(
+                Emission.objects.filter(batch=batch).values_list("number", flat=True)
+            )
+
+        return emit
+    if path == "api":
+        items = [
+            {
+                "sequence": sequence.pk,
+                "quantity": batch_size,
+                "detail": "benchmark",
+                "destination": "-",
+            }
+        ]
+        return lambda: [
+            number
+            for result in create_emissions(user, items)
+            for number in result["numbers"]
+        ]
+    raise ValueError(path)
+
+
+def _work(arguments):
+    path, sequence_id, user_id, batch_size, iterations = arguments
+    sequence = Sequence.objects.select_related("department").get(pk=sequence_id)
+    user = CustomUser.objects.get(pk=user_id)
+    operation = _operation(path, sequence, user, batch_size)
+    numbers, latencies, errors = [], [], []
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            try:
+                numbers += operation()
+            except Exception as error:
+                errors.append(repr(error))
+                continue
+            latencies.append(time.perf_counter() - start)
+        # Hi-lo blocks held by this worker go to the gap ledger.
+        release_blocks("benchmark")
+    finally:
+        connection.close()
+    return numbers, latencies, errors
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the emission paths from concurrent workers against the "
+        "configured database and reports throughput, latency and duplicate "
+        "or skipped numbers per sequence."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            action="append",
+            choices=PATHS,
+            help="Emission path to benchmark, repeat for several (default: all).",
+        )
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument(
+            "--iterations", type=int, default=50, help="Operations per worker."
+        )
+        parser.add_argument(
+            "--concurrency", choices=["threads", "processes"], default="threads"
+        )
+        parser.add_argument(
+            "--allocation",
+            choices=[choice for choice, _ in Sequence.ALLOCATION_CHOICES],
+            default=Sequence.GAPLESS,
+        )
+        parser.add_argument("--block-size", type=int, default=50)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10,
+            help="Emissions per operation for the batch and api paths.",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the benchmark department, sequences and emissions.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["iterations"] < 1:
+            raise CommandError("--workers and --iterations must be positive")
+        self.stdout.write(
+            f"Database: {connection.vendor}, {options['workers']} "
+            f"{options['concurrency']} x {options['iterations']} operations, "
+            f"{options['allocation']} allocation"
+        )
+        tag = f"benchmark-{uuid.uuid4().hex[:8]}"
+        department = Department.objects.create(name=tag, description=tag)
+        document = Document.objects.create(name=tag)
+        year = Year.objects.create(year=0)
+        user = CustomUser.objects.create(username=tag, email=f"{tag}@example.com")
+        UserDepartment.objects.create(user=user, department=department)
+        sequences = []
+        try:
+            for path in options["path"] or PATHS:
+                sequence = Sequence.objects.create(
+                    department=department,
+                    document=document,
+                    year=year,
+                    sequence=0,
+                    allocation=options["allocation"],
+                    block_size=options["block_size"],
+                )
+                sequences.append(sequence)
+                self._run(path, sequence, user, options)
+        finally:
+            if not options["keep"]:
+                # one emission_seq_<hex> per path in native mode
+                for sequence in sequences:
+                    drop_native_sequence(sequence)
+                Emission.all_objects.filter(sequence__department=department).delete()
+                Department.all_objects.filter(pk=department.pk).delete()
+                Document.all_objects.filter(pk=document.pk).delete()
+                Year.all_objects.filter(pk=year.pk).delete()
+                CustomUser.all_objects.filter(pk=user.pk).delete()
+
+    def _run(self, path, sequence, user, options):
+        batch_size = options["batch_size"] if path in ("batch", "api") else 1
+        arguments = [
+            (path, sequence.pk, user.pk, batch_size, options["iterations"])
+        ] * options["workers"]
+        start = time.perf_counter()
+        if options["concurrency"] == "processes":
+            # Forked children must not share the parent's connections.
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(options["workers"]) as pool:
+                results = pool.map(_work, arguments)
+        else:
+            results = [None] * options["workers"]
+
+            def target(index):
+                results[index] = _work(arguments[index])
+
+            threads = [
+                threading.Thread(target=target, args=(index,))
+                for index in range(options["workers"])
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+
+        numbers = [number for result in results for number in result[0]]
+        latencies = sorted(latency for result in results for latency in result[1])
+        errors = [error for result in results for error in result[2]]
+        counts = Counter(numbers)
+        duplicates = sorted(number for number, count in counts.items() if count > 1)
+        stored_duplicates = (
+            Emission.all_objects.filter(sequence=sequence)
+            .values("number")
+            .annotate(count=Count("id"))
+            .filter(count__gt=1)
+            .count()
+        )
+        ledger = set()
+        for start_number, end_number in SequenceGap.objects.filter(
+            sequence=sequence
+        ).values_list("start", "end"):
+            ledger.update(range(start_number, end_number + 1))
+        sequence.refresh_from_db()
+        refresh_native_mirrors([sequence])
+        skipped = sorted(set(range(1, sequence.sequence + 1)) - set(counts) - ledger)
+
+        self.stdout.write(f"\n[{path}] sequence {sequence.pk}")
+        self.stdout.write(
+            f"  allocations: {len(numbers)} in {elapsed:.2f}s "
+            f"({len(numbers) / elapsed if elapsed else 0:.1f}/s)"
+        )
+        self.stdout.write(
+            f"  latency per operation: p50 {_percentile(latencies, 50) * 1000:.1f}ms, "
+            f"p99 {_percentile(latencies, 99) * 1000:.1f}ms"
+        )
+        self.stdout.write(f"  errors: {len(errors)}")
+        for error, count in Counter(errors).most_common(3):
+            self.stdout.write(f"    {count} x {error}")
+        self.stdout.write(f"  numbers in gap ledger: {len(ledger)}")
+        failed = duplicates or skipped or stored_duplicates
+        style = self.style.ERROR if failed else self.style.SUCCESS
+        self.stdout.write(
+            style(
+                f"  duplicates: {len(duplicates)} handed out, {stored_duplicates} stored; "
+                f"skipped: {len(skipped)}"
+            )
+        )
+        if duplicates:
+            self.stdout.write(f"    duplicated: {duplicates[:20]}")
+        if skipped:
+            self.stdout.write(f"    skipped: {skipped[:20]}")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from emission.blobs import collect_blobs
+
+
+class Command(BaseCommand):
+    help = "Removes the stored files no emission file points to, even a deleted one."
+
+    def handle(self, *args, **options):
+        collected = collect_blobs()
+        self.stdout.write(self.style.SUCCESS(f"{collected} blobs removed"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from emission.idempotency import expire_keys
+
+
+class Command(BaseCommand):
+    help = "Deletes the idempotency keys older than EMISSION_IDEMPOTENCY_TTL."
+
+    def handle(self, *args, **options):
+        deleted = expire_keys()
+        self.stdout.write(self.style.SUCCESS(f"{deleted} idempotency keys deleted"))
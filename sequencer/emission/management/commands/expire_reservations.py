@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from emission.reservations import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Marks expired number reservations so their numbers are recycled."
+
+    def handle(self, *args, **options):
+        expired = expire_reservations()
+        self.stdout.write(self.style.SUCCESS(f"{expired} reservations expired"))
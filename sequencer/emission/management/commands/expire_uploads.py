@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from emission.uploads import expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Discards the resumable uploads that stopped receiving chunks."
+
+    def handle(self, *args, **options):
+        expired = expire_uploads()
+        self.stdout.write(self.style.SUCCESS(f"{expired} uploads discarded"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from emission.models import Emission, update_file_counts
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the active files of every emission and fixes the stored "
+        "file counts that drifted."
+    )
+
+    def handle(self, *args, **options):
+        fixed = update_file_counts(Emission.all_objects.all())
+        self.stdout.write(self.style.SUCCESS(f"{fixed} file counts fixed"))
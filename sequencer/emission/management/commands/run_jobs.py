@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from emission.jobs import claim_next, run
+
+
+class Command(BaseCommand):
+    help = "Runs queued background jobs (large emission batches and bulk operations)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait between polls when the queue is empty.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run the pending jobs and exit instead of polling forever.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = claim_next()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+            self.stdout.write(f"Running {job.kind} job {job.pk}")
+            job = run(job)
+            if job.status == job.FAILED:
+                self.stderr.write(f"Job {job.pk} failed:\n{job.error}")
+            else:
+                self.stdout.write(self.style.SUCCESS(f"Job {job.pk} done"))
@@ -0,0 +1,113 @@
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import UserDepartment
+
+# hits and misses of this process, a shared counter would cost a cache write
+# per request and lose counts on the file cache
+_lock = threading.Lock()
+_stats = Counter()
+
+
+def cache_key(user_id):
+    return f"emission:membership:{user_id}"
+
+
+class Membership:
+    """
+    The departments of a user, read once from the cache or with a single
+    query and answering the permission checks of a request from memory.
+    """
+
+    def __init__(self, user):
+        self.user_departments = []
+        if user.is_authenticated:
+            self.user_departments = _load(user)
+        self._members = {row.department_id for row in self.user_departments}
+        self._admins = {
+            row.department_id for row in self.user_departments if row.can_administrate
+        }
+
+    @property
+    def administrated(self):
+        """
+        The ``UserDepartment`` rows of the departments the user administrates.
+        """
+        return [row for row in self.user_departments if row.can_administrate]
+
+    @property
+    def department_ids(self):
+        return list(self._members)
+
+    def is_member(self, department):
+        return _pk(department) in self._members
+
+    def is_admin(self, department=None):
+        """
+        Returns whether the user administrates ``department``, or any
+        department when it is not given.
+        """
+        if department is None:
+            return bool(self._admins)
+        return _pk(department) in self._admins
+
+
+def _pk(department):
+    return getattr(department, "pk", department)
+
+
+def _load(user):
+    queryset = UserDepartment.objects.filter(user=user).select_related("department")
+    if not settings.EMISSION_SHARED_CACHE:
+        return list(queryset)
+    key = cache_key(user.pk)
+    user_departments = cache.get(key)
+    if user_departments is not None:
+        _count("hits")
+        return user_departments
+    _count("misses")
+    user_departments = list(queryset)
+    cache.set(key, user_departments, settings.EMISSION_MEMBERSHIP_CACHE_TIMEOUT)
+    return user_departments
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def invalidate(user_ids):
+    """
+    Drops the cached departments of ``user_ids``, the next request of each
+    user reads them again.
+    """
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
+
+
+def cache_stats():
+    """
+    Returns the hits and misses of the membership cache in this process
+    since the last reset.
+    """
+    with _lock:
+        return {"hits": _stats["hits"], "misses": _stats["misses"]}
+
+
+def reset_cache_stats():
+    with _lock:
+        _stats.clear()
+
+
+def get_membership(user):
+    """
+    Returns the membership of ``user``, kept on the user object so the
+    views, forms and context processors of a request share one query.
+    """
+    try:
+        return user._emission_membership
+    except AttributeError:
+        user._emission_membership = Membership(user)
+        return user._emission_membership
@@ -1,6 +1,14 @@
+import logging
+
+from django.conf import settings as django_settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
 from django.utils.translation import activate
 
-from emission.models import GlobalSettings
+from emission import querystats
+from emission.global_settings import get_global_settings
+
+logger = logging.getLogger(__name__)
 
 class ActivateLanguageMiddleware:
     def __init__(self, get_response):
@@ -8,8 +16,44 @@ class ActivateLanguageMiddleware:
 
     def __call__(self, request):
         # Aquí puedes implementar la lógica para activar el idioma según la solicitud
-        settings = GlobalSettings.objects.first()
+        settings = get_global_settings(request)
         language = settings.language if settings else 'en'
         activate(language)
         response = self.get_response(request)
-        return response
\ No newline at end of file
+        return response
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Counts the SQL statements and database time of every request to the
+    emission views, and flags the statements run many times in a request
+    (N+1 queries). Enabled by ``EMISSION_QUERY_INSTRUMENTATION``, the summary
+    is shown at ``admin/queries/`` and requests over budget are logged.
+    """
+
+    def __init__(self, get_response):
+        if not django_settings.EMISSION_QUERY_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = querystats.QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        match = request.resolver_match
+        if match is None or match.app_name != "emissions":
+            return response
+        repeated = querystats.record(
+            match.view_name,
+            recorder,
+            django_settings.EMISSION_QUERY_REPEAT_THRESHOLD,
+        )
+        if repeated or recorder.queries > django_settings.EMISSION_QUERY_BUDGET:
+            logger.warning(
+                "%s ran %d queries in %.1f ms, repeated: %s",
+                match.view_name,
+                recorder.queries,
+                recorder.duration * 1000,
+                "; ".join(f"{count}x {shape[:200]}" for shape, count in repeated),
+            )
+        return response
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:23
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0012_alter_emission_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sequence',
+            name='allocation',
+            field=models.CharField(choices=[('gapless', 'Gapless'), ('hilo', 'Hi-lo blocks')], default='gapless', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='sequence',
+            name='block_size',
+            field=models.PositiveIntegerField(default=50),
+        ),
+        migrations.CreateModel(
+            name='SequenceGap',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('deleted_at', models.DateTimeField(blank=True, null=True)),
+                ('start', models.IntegerField()),
+                ('end', models.IntegerField()),
+                ('reason', models.CharField(max_length=100)),
+                ('sequence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='emission.sequence')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0013_sequence_allocation_sequence_block_size_sequencegap'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sequence',
+            name='allocation',
+            field=models.CharField(choices=[('gapless', 'Gapless'), ('hilo', 'Hi-lo blocks'), ('native', 'Database sequence')], default='gapless', max_length=10),
+        ),
+    ]
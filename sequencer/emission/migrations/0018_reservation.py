@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:28
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0017_idempotencykey_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('deleted_at', models.DateTimeField(blank=True, null=True)),
+                ('number', models.IntegerField()),
+                ('status', models.CharField(choices=[('reserved', 'Reserved'), ('confirmed', 'Confirmed'), ('expired', 'Expired')], default='reserved', max_length=10)),
+                ('expires_at', models.DateTimeField()),
+                ('emission', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='emission.emission')),
+                ('sequence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='emission.sequence')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='emission_re_status_a374c9_idx'), models.Index(fields=['sequence', 'status', 'number'], name='emission_re_sequenc_cbe5dc_idx')],
+            },
+        ),
+    ]
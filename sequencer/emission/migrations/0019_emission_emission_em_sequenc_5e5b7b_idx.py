@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0018_reservation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emission',
+            index=models.Index(fields=['sequence', 'number'], name='emission_em_sequenc_5e5b7b_idx'),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:32
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+POSTGRESQL_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE emission_emission ADD COLUMN search_vector tsvector"
+    " GENERATED ALWAYS AS (to_tsvector('simple',"
+    " coalesce(detail, '') || ' ' || coalesce(destination, ''))) STORED",
+    "CREATE INDEX emission_emission_search_idx"
+    " ON emission_emission USING gin (search_vector)",
+    "CREATE INDEX emission_emission_detail_trgm_idx"
+    " ON emission_emission USING gin (detail gin_trgm_ops)",
+    "CREATE INDEX emission_emission_destination_trgm_idx"
+    " ON emission_emission USING gin (destination gin_trgm_ops)",
+]
+POSTGRESQL_REVERSE = [
+    "DROP INDEX IF EXISTS emission_emission_destination_trgm_idx",
+    "DROP INDEX IF EXISTS emission_emission_detail_trgm_idx",
+    "DROP INDEX IF EXISTS emission_emission_search_idx",
+    "ALTER TABLE emission_emission DROP COLUMN IF EXISTS search_vector",
+]
+# The emission id is indexed too, so the triggers find the row to replace
+# through the full text index.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE emission_emission_fts USING fts5("
+    "emission_id, detail, destination, tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO emission_emission_fts (emission_id, detail, destination)"
+    " SELECT id, detail, destination FROM emission_emission",
+    "CREATE TRIGGER emission_emission_fts_insert AFTER INSERT ON emission_emission"
+    " BEGIN"
+    " INSERT INTO emission_emission_fts (emission_id, detail, destination)"
+    " VALUES (new.id, new.detail, new.destination);"
+    " END",
+    "CREATE TRIGGER emission_emission_fts_update"
+    " AFTER UPDATE OF detail, destination ON emission_emission"
+    " BEGIN"
+    " DELETE FROM emission_emission_fts"
+    " WHERE emission_emission_fts MATCH 'emission_id: \"' || old.id || '\"';"
+    " INSERT INTO emission_emission_fts (emission_id, detail, destination)"
+    " VALUES (new.id, new.detail, new.destination);"
+    " END",
+    "CREATE TRIGGER emission_emission_fts_delete AFTER DELETE ON emission_emission"
+    " BEGIN"
+    " DELETE FROM emission_emission_fts"
+    " WHERE emission_emission_fts MATCH 'emission_id: \"' || old.id || '\"';"
+    " END",
+]
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS emission_emission_fts_delete",
+    "DROP TRIGGER IF EXISTS emission_emission_fts_update",
+    "DROP TRIGGER IF EXISTS emission_emission_fts_insert",
+    "DROP TABLE IF EXISTS emission_emission_fts",
+]
+
+
+def _execute(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        _execute(schema_editor, POSTGRESQL_FORWARD)
+    elif vendor == "sqlite":
+        try:
+            _execute(schema_editor, SQLITE_FORWARD[:1])
+        except OperationalError:
+            # SQLite built without FTS5, the search falls back to LIKE.
+            return
+        _execute(schema_editor, SQLITE_FORWARD[1:])
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        _execute(schema_editor, POSTGRESQL_REVERSE)
+    elif vendor == "sqlite":
+        _execute(schema_editor, SQLITE_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0019_emission_emission_em_sequenc_5e5b7b_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
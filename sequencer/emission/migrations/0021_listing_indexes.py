@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0020_emission_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emission',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'received', '-number'], name='emission_user_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emission',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['sequence', 'received', '-number'], name='emission_sequence_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emissionfile',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['emission'], name='emissionfile_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sequence',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['department', 'year', '-can_emit', 'sequence'], name='sequence_department_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userdepartment',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'department', 'can_administrate'], name='userdepartment_user_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_files(apps, schema_editor):
+    Emission = apps.get_model("emission", "Emission")
+    EmissionFile = apps.get_model("emission", "EmissionFile")
+    Emission.objects.update(
+        file_count=Coalesce(
+            Subquery(
+                EmissionFile.objects.filter(emission=OuterRef("pk"), is_active=True)
+                .order_by()
+                .values("emission")
+                .annotate(total=Count("pk"))
+                .values("total")
+            ),
+            0,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0021_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emission',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_files, migrations.RunPython.noop),
+    ]
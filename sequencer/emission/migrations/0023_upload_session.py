@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:52
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0022_emission_file_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('deleted_at', models.DateTimeField(blank=True, null=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('name', models.TextField(blank=True, max_length=500)),
+                ('description', models.TextField(blank=True, max_length=1000)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('checksum', models.CharField(max_length=64)),
+                ('expires_at', models.DateTimeField()),
+                ('emission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='emission.emission')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='emission_up_expires_fc833d_idx')],
+            },
+        ),
+    ]
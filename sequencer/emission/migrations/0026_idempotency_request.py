@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+def mark_done(apps, schema_editor):
+    # Keys with a stored result belong to finished requests
+    IdempotencyKey = apps.get_model("emission", "IdempotencyKey")
+    IdempotencyKey.objects.filter(result__isnull=False).update(status="done")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emission', '0025_job_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='path',
+            field=models.CharField(default='', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='fingerprint',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='status',
+            field=models.CharField(choices=[('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='running', max_length=10),
+        ),
+        migrations.RunPython(mark_done, migrations.RunPython.noop),
+    ]
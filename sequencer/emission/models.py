@@ -1,5 +1,8 @@
+import hashlib
+import secrets
 import uuid
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from allauth.socialaccount.adapter import DefaultSocialAccountAdapter
@@ -71,21 +74,54 @@ class Document(SoftDeleteMixin):
 
 
 class Sequence(SoftDeleteMixin):
+    GAPLESS = "gapless"
+    HILO = "hilo"
+    NATIVE = "native"
+    ALLOCATION_CHOICES = [
+        (GAPLESS, "Gapless"),
+        (HILO, "Hi-lo blocks"),
+        (NATIVE, "Database sequence"),
+    ]
+
     department = models.ForeignKey(Department, on_delete=models.CASCADE)
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
     year = models.ForeignKey(Year, on_delete=models.CASCADE)
     sequence = models.IntegerField()
     can_emit = models.BooleanField(default=True)
+    allocation = models.CharField(
+        max_length=10, choices=ALLOCATION_CHOICES, default=GAPLESS
+    )
+    block_size = models.PositiveIntegerField(default=50)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["department", "year", "-can_emit", "sequence"],
+                condition=models.Q(is_active=True),
+                name="sequence_department_list_idx",
+            )
+        ]
 
     def increment(self, quantity=1):
-        self.sequence += quantity
-        self.save()
+        from .allocation import allocate
+
+        self.sequence = allocate(self, quantity)[-1]
         return self.sequence
 
     def __str__(self):
         return f"{self.sequence}: {self.department} - {self.document} - {self.year}"
 
 
+class SequenceGap(SoftDeleteMixin):
+    sequence = models.ForeignKey(Sequence, on_delete=models.CASCADE)
+    start = models.IntegerField()
+    end = models.IntegerField()
+    reason = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f"{self.sequence}: {self.start}-{self.end} ({self.reason})"
+
+
 class Emission(SoftDeleteMixin):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     sequence = models.ForeignKey(Sequence, on_delete=models.CASCADE)
@@ -104,18 +140,198 @@ class Emission(SoftDeleteMixin):
     )
     number = models.IntegerField()
     batch = models.UUIDField(null=True, blank=True)
+    # Active files, maintained by EmissionFile.save() and delete()
+    file_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sequence", "number"]),
+            # Listings, in the order of the index and admin_index views.
+            models.Index(
+                fields=["user", "received", "-number"],
+                condition=models.Q(is_active=True),
+                name="emission_user_list_idx",
+            ),
+            models.Index(
+                fields=["sequence", "received", "-number"],
+                condition=models.Q(is_active=True),
+                name="emission_sequence_list_idx",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # A stale file_count of this instance must not overwrite the column,
+            # deferred fields are left alone instead of being loaded one by one.
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name != "file_count"
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.number} - {self.detail} - {self.destination} - {self.date}"
 
 
+def active_file_count():
+    """
+    Subquery counting the active files of the emission of the outer query.
+    """
+    return Coalesce(
+        models.Subquery(
+            EmissionFile.all_objects.filter(
+                emission=models.OuterRef("pk"), is_active=True
+            )
+            .order_by()
+            .values("emission")
+            .annotate(total=models.Count("pk"))
+            .values("total")
+        ),
+        0,
+    )
+
+
+def update_file_counts(emissions):
+    """
+    Stores the active file count of ``emissions``, a queryset, with a single
+    UPDATE. Returns how many emissions changed.
+    """
+    return emissions.exclude(file_count=active_file_count()).update(
+        file_count=active_file_count()
+    )
+
+
+def add_file_count(emission_id, delta):
+    """
+    Adds ``delta`` to the file count of an emission in the UPDATE itself, so
+    concurrent changes to its files never overwrite each other.
+    """
+    if delta:
+        Emission.all_objects.filter(pk=emission_id).update(
+            file_count=Greatest(models.F("file_count") + delta, 0)
+        )
+
+
+class Reservation(SoftDeleteMixin):
+    RESERVED = "reserved"
+    CONFIRMED = "confirmed"
+    EXPIRED = "expired"
+    STATUS_CHOICES = [
+        (RESERVED, "Reserved"),
+        (CONFIRMED, "Confirmed"),
+        (EXPIRED, "Expired"),
+    ]
+
+    sequence = models.ForeignKey(Sequence, on_delete=models.CASCADE)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    number = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RESERVED)
+    expires_at = models.DateTimeField()
+    emission = models.ForeignKey(
+        Emission, on_delete=models.SET_NULL, null=True, blank=True
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "expires_at"]),
+            models.Index(fields=["sequence", "status", "number"]),
+        ]
+
+    def __str__(self):
+        return f"{self.number}: {self.sequence.document} - {self.sequence.year} ({self.status})"
+
+
+class Blob(SoftDeleteMixin):
+    """
+    Content of an uploaded file, stored once however many emission files
+    share it.
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to="blobs/")
+    size = models.BigIntegerField()
+    # active emission files pointing here, blobs left without any are
+    # removed by `manage.py collect_blobs`
+    references = models.PositiveIntegerField(default=0, editable=False)
+
+    def __str__(self):
+        return self.sha256
+
+
+def active_references():
+    """
+    Subquery counting the active files sharing the blob of the outer query.
+    """
+    return Coalesce(
+        models.Subquery(
+            EmissionFile.all_objects.filter(blob=models.OuterRef("pk"), is_active=True)
+            .order_by()
+            .values("blob")
+            .annotate(total=models.Count("pk"))
+            .values("total")
+        ),
+        0,
+    )
+
+
+def update_blob_references(blobs):
+    """
+    Stores the reference count of ``blobs``, a queryset, with a single
+    UPDATE. Returns how many blobs changed.
+    """
+    return blobs.exclude(references=active_references()).update(
+        references=active_references()
+    )
+
+
 class EmissionFile(SoftDeleteMixin):
     emission = models.ForeignKey(Emission, on_delete=models.CASCADE)
     file = models.FileField(upload_to="emission_files/")
+    # shared content of the file, None for files stored before blobs
+    blob = models.ForeignKey(
+        Blob, on_delete=models.SET_NULL, null=True, blank=True, editable=False
+    )
+    # name of the uploaded file, the blob is stored under its checksum
+    filename = models.CharField(max_length=255, blank=True, editable=False)
     url = models.URLField(null=True, blank=True)
     name = models.TextField(max_length=500, blank=True)
     description = models.TextField(max_length=1000, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["emission"],
+                condition=models.Q(is_active=True),
+                name="emissionfile_active_idx",
+            )
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            # the row lock orders concurrent saves of this file
+            previous = (
+                None
+                if self._state.adding
+                else EmissionFile.all_objects.select_for_update()
+                .filter(pk=self.pk)
+                .values("emission_id", "is_active")
+                .first()
+            )
+            super().save(*args, **kwargs)
+            before = previous and previous["is_active"] and previous["emission_id"]
+            after = self.is_active and self.emission_id
+            if before != after:
+                if before:
+                    add_file_count(before, -1)
+                if after:
+                    add_file_count(after, 1)
+            if self.blob_id:
+                update_blob_references(Blob.all_objects.filter(pk=self.blob_id))
+
     def __str__(self):
         return f"{self.emission} - {self.file}"
 
@@ -125,9 +341,121 @@ class UserDepartment(SoftDeleteMixin):
     department = models.ForeignKey(Department, on_delete=models.CASCADE)
     can_administrate = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "department", "can_administrate"],
+                condition=models.Q(is_active=True),
+                name="userdepartment_user_idx",
+            )
+        ]
+
     def __str__(self):
         return f"{self.department} - {self.user} - {'Admin' if self.can_administrate else 'User'}"
 
+class Job(SoftDeleteMixin):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Last sign of life of the worker running the job, see jobs.fail_expired()
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"{self.kind} - {self.user} - {self.status}"
+
+
+class ApiToken(SoftDeleteMixin):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)
+    # sha256 of the token, the token itself is only shown once
+    key = models.CharField(max_length=64, unique=True, editable=False)
+    last_used_at = models.DateTimeField(null=True, blank=True)
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def set_token(self):
+        token = secrets.token_urlsafe(32)
+        self.key = self.hash(token)
+        return token
+
+    def __str__(self):
+        return f"{self.name} - {self.user}"
+
+
+class UploadSession(SoftDeleteMixin):
+    emission = models.ForeignKey(Emission, on_delete=models.CASCADE)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    name = models.TextField(max_length=500, blank=True)
+    description = models.TextField(max_length=1000, blank=True)
+    size = models.BigIntegerField()
+    # bytes received so far, the next chunk starts here
+    offset = models.BigIntegerField(default=0)
+    # sha256 of the whole file, checked when the upload is finalized
+    checksum = models.CharField(max_length=64)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=["expires_at"])]
+
+    def __str__(self):
+        return f"{self.filename} - {self.offset}/{self.size}"
+
+
+class IdempotencyKey(SoftDeleteMixin):
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # The request the key belongs to, see idempotency.fingerprint()
+    path = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    # None while the first request is still running
+    result = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key_per_user"
+            )
+        ]
+        indexes = [models.Index(fields=["created_at"])]
+
+    def __str__(self):
+        return f"{self.key} - {self.user}"
+
+
 class CustomSocialAccountAdapter(DefaultSocialAccountAdapter):
 
     def populate_user(self, request, sociallogin, data):
@@ -0,0 +1,112 @@
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from django.utils import timezone
+
+_lock = threading.Lock()
+_views = {}
+_since = timezone.now()
+
+_in_list = re.compile(r"\((?:%s, )+%s\)")
+
+
+def fingerprint(sql):
+    """
+    Returns the shape of a statement: the parameters are already
+    placeholders, ``IN`` lists of any length are folded into one.
+    """
+    return _in_list.sub("(%s, ...)", sql)
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper counting the statements of a request, their
+    time and how many times each shape ran.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries += 1
+            self.shapes[fingerprint(sql)] += 1
+
+    def repeated(self, threshold):
+        """
+        Returns the ``(shape, count)`` pairs that ran ``threshold`` times or
+        more, the sign of a query run once per row (N+1).
+        """
+        return [
+            (shape, count)
+            for shape, count in self.shapes.most_common()
+            if count >= threshold
+        ]
+
+
+def record(view, recorder, threshold):
+    """
+    Adds a request of ``view`` to the summary of this process.
+    """
+    repeated = recorder.repeated(threshold)
+    with _lock:
+        stats = _views.setdefault(
+            view,
+            {
+                "view": view,
+                "requests": 0,
+                "queries": 0,
+                "max_queries": 0,
+                "duration": 0.0,
+                "max_duration": 0.0,
+                "n_plus_one": 0,
+                "repeated": [],
+            },
+        )
+        stats["requests"] += 1
+        stats["queries"] += recorder.queries
+        stats["max_queries"] = max(stats["max_queries"], recorder.queries)
+        stats["duration"] += recorder.duration
+        stats["max_duration"] = max(stats["max_duration"], recorder.duration)
+        if repeated:
+            stats["n_plus_one"] += 1
+            stats["repeated"] = repeated[:5]
+    return repeated
+
+
+def summary():
+    """
+    Returns the statistics of every view recorded by this process, the
+    views with the most queries per request first.
+    """
+    with _lock:
+        views = [dict(stats) for stats in _views.values()]
+    for stats in views:
+        stats["average_queries"] = stats["queries"] / stats["requests"]
+        stats["average_duration"] = stats["duration"] / stats["requests"]
+    return sorted(views, key=lambda stats: stats["average_queries"], reverse=True)
+
+
+def process():
+    """
+    Returns the pid of this process and when its summary started. Every
+    server worker keeps its own summary, the page shows the worker that
+    answered the request.
+    """
+    return {"pid": os.getpid(), "since": _since}
+
+
+def reset():
+    global _since
+    with _lock:
+        _views.clear()
+        _since = timezone.now()
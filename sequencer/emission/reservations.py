@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .allocation import allocate
+from .models import Emission, Reservation
+
+
+class ReservationExpired(Exception):
+    pass
+
+
+def _recyclable(now):
+    return Q(status=Reservation.EXPIRED) | Q(
+        status=Reservation.RESERVED, expires_at__lt=now
+    )
+
+
+def reserve(sequence, user, quantity=1):
+    """
+    Reserves ``quantity`` numbers of a sequence for ``user``.
+
+    Numbers of expired reservations are handed out again before new numbers
+    are allocated, so abandoned reservations do not leave gaps. Each
+    recycled row is claimed with a conditional UPDATE, no lock is held
+    while the user fills in the emission.
+
+    Returns:
+        list: The reservations, ordered by number.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=settings.EMISSION_RESERVATION_TTL)
+    claimed = []
+    candidates = (
+        Reservation.objects.filter(_recyclable(now), sequence=sequence)
+        .order_by("number")
+        .values_list("pk", flat=True)
+    )
+    for pk in candidates[: quantity * 2]:
+        if len(claimed) == quantity:
+            break
+        if Reservation.objects.filter(_recyclable(now), pk=pk).update(
+            status=Reservation.RESERVED, user=user, expires_at=expires_at
+        ):
+            claimed.append(pk)
+    reservations = list(Reservation.objects.filter(pk__in=claimed))
+    missing = quantity - len(reservations)
+    if missing:
+        with transaction.atomic():
+            reservations += Reservation.objects.bulk_create(
+                Reservation(
+                    sequence=sequence, user=user, number=number, expires_at=expires_at
+                )
+                for number in allocate(sequence, missing)
+            )
+    return sorted(reservations, key=lambda reservation: reservation.number)
+
+
+def confirm(reservation, detail, destination):
+    """
+    Creates the emission of a reservation that has not expired yet.
+
+    The reservation must still belong to its user: an expired number may
+    have been recycled to someone else since ``reservation`` was read.
+    """
+    with transaction.atomic():
+        reserved = Reservation.objects.filter(
+            pk=reservation.pk,
+            user_id=reservation.user_id,
+            status=Reservation.RESERVED,
+            expires_at__gte=timezone.now(),
+        )
+        confirmed = reserved.update(status=Reservation.CONFIRMED)
+        if not confirmed:
+            raise ReservationExpired("The reservation has expired")
+        # the row as confirmed, not the instance read before
+        row = Reservation.objects.values("sequence_id", "user_id", "number").get(
+            pk=reservation.pk
+        )
+        emission = Emission.objects.create(
+            detail=detail, destination=destination, **row
+        )
+        Reservation.objects.filter(pk=reservation.pk).update(emission=emission)
+    reservation.status = Reservation.CONFIRMED
+    reservation.emission = emission
+    return emission
+
+
+def expire_reservations():
+    """
+    Marks reservations past their expiry as expired, returning how many.
+    """
+    return Reservation.objects.filter(
+        status=Reservation.RESERVED, expires_at__lt=timezone.now()
+    ).update(status=Reservation.EXPIRED)
@@ -0,0 +1,174 @@
+import re
+from datetime import datetime
+
+from django.db import connections
+from django.db.models import F, FloatField, Func, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+from .models import Sequence
+
+FTS_TABLE = "emission_emission_fts"
+
+# Recreated after every migrate: SQLite rebuilds a table to alter it and the
+# rebuild drops its triggers.
+SQLITE_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert"
+    " AFTER INSERT ON emission_emission"
+    " BEGIN"
+    f" INSERT INTO {FTS_TABLE} (emission_id, detail, destination)"
+    " VALUES (new.id, new.detail, new.destination);"
+    " END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update"
+    " AFTER UPDATE OF detail, destination ON emission_emission"
+    " BEGIN"
+    f" DELETE FROM {FTS_TABLE}"
+    f" WHERE {FTS_TABLE} MATCH 'emission_id: \"' || old.id || '\"';"
+    f" INSERT INTO {FTS_TABLE} (emission_id, detail, destination)"
+    " VALUES (new.id, new.detail, new.destination);"
+    " END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete"
+    " AFTER DELETE ON emission_emission"
+    " BEGIN"
+    f" DELETE FROM {FTS_TABLE}"
+    f" WHERE {FTS_TABLE} MATCH 'emission_id: \"' || old.id || '\"';"
+    " END",
+]
+
+_fts_tables = {}
+
+
+def _has_fts_table(connection):
+    if connection.alias not in _fts_tables:
+        _fts_tables[connection.alias] = (
+            FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_tables[connection.alias]
+
+
+def install_triggers(connection):
+    """
+    Creates the triggers keeping the SQLite full text table in sync with the
+    emissions, when the table exists.
+    """
+    _fts_tables.pop(connection.alias, None)
+    if connection.vendor != "sqlite" or not _has_fts_table(connection):
+        return
+    with connection.cursor() as cursor:
+        for statement in SQLITE_TRIGGERS:
+            cursor.execute(statement)
+
+
+def _fts_query(query):
+    """
+    Builds an FTS5 query matching every word of ``query`` as a prefix of a
+    word of the detail or the destination.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return "{detail destination}: (%s)" % " AND ".join(f'"{word}"*' for word in words)
+
+
+def _like_pattern(query):
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class _Rank(Func):
+    """
+    Correlated subquery ranking the emission of the outer query, ``{pk}`` in
+    ``sql`` is replaced by its primary key column, under whatever alias the
+    outer query gives the table.
+    """
+
+    output_field = FloatField()
+
+    def __init__(self, sql, params):
+        super().__init__(F("pk"))
+        self.sql = sql
+        self.params = params
+
+    def as_sql(self, compiler, connection, **extra_context):
+        pk_sql, pk_params = compiler.compile(self.get_source_expressions()[0])
+        return f"({self.sql.replace('{pk}', pk_sql)})", (*self.params, *pk_params)
+
+
+def _text_search(queryset, query):
+    """
+    Returns the condition matching ``query`` against the detail and the
+    destination, and the expression ranking the matches.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == "postgresql":
+        pattern = _like_pattern(query)
+        match = RawSQL(
+            "SELECT id FROM emission_emission"
+            " WHERE search_vector @@ websearch_to_tsquery('simple', %s)"
+            " OR detail ILIKE %s OR destination ILIKE %s",
+            (query, pattern, pattern),
+        )
+        rank = _Rank(
+            "SELECT ts_rank(search.search_vector,"
+            " websearch_to_tsquery('simple', %s))"
+            " + GREATEST(similarity(search.detail, %s),"
+            " similarity(search.destination, %s))"
+            " FROM emission_emission search WHERE search.id = {pk}",
+            (query, query, query),
+        )
+        return Q(pk__in=match), rank
+    if connection.vendor == "sqlite" and _has_fts_table(connection):
+        fts_query = _fts_query(query)
+        if fts_query is None:
+            return Q(pk__in=[]), Value(0.0)
+        match = RawSQL(
+            f"SELECT emission_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+            (fts_query,),
+        )
+        # bm25() is negative, the better the match the lower.
+        rank = _Rank(
+            f"SELECT -rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH"
+            " %s || ' AND emission_id: \"' || {pk} || '\"'",
+            (fts_query,),
+        )
+        return Q(pk__in=match), rank
+    return Q(detail__icontains=query) | Q(destination__icontains=query), Value(0.0)
+
+
+def search(queryset, query):
+    """
+    Filters emissions by the ``q`` search of the listings.
+
+    The detail and the destination are matched through the full text index
+    of the database: a ``tsvector`` column with GIN and trigram indexes on
+    PostgreSQL, an FTS5 table on SQLite. A number also matches the emission
+    number and the year of the sequence, a ``dd/mm/yyyy`` date the emission
+    date, and any text the document name.
+
+    Args:
+        queryset (QuerySet): The emissions to search.
+        query (str): The search text.
+
+    Returns:
+        QuerySet: The matching emissions annotated with ``search_rank``, the
+        higher the better.
+    """
+    text, rank = _text_search(queryset, query)
+    condition = text | Q(
+        sequence__in=Sequence.objects.filter(document__name__icontains=query)
+    )
+    try:
+        query_number = int(query)
+    except ValueError:
+        pass
+    else:
+        condition |= Q(number=query_number) | Q(
+            sequence__in=Sequence.objects.filter(year__year=query_number)
+        )
+    try:
+        query_date = datetime.strptime(query, "%d/%m/%Y")
+    except ValueError:
+        pass
+    else:
+        condition |= Q(date=query_date)
+    return queryset.filter(condition).annotate(search_rank=Coalesce(rank, 0.0))
@@ -1,8 +1,75 @@
-from django.db.models.signals import post_migrate
+from django.db import connections
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.dispatch import receiver
-from .models import GlobalSettings
+from . import global_settings
+from .allocation import drop_native_sequence, leave_native_sequence
+from .membership import invalidate
+from .models import (
+    Blob,
+    CustomUser,
+    Department,
+    EmissionFile,
+    GlobalSettings,
+    Sequence,
+    UserDepartment,
+    add_file_count,
+    update_blob_references,
+)
+from .search import install_triggers
 
 @receiver(post_migrate)
 def create_default_global_settings(sender, **kwargs):
     if not GlobalSettings.objects.exists():
-        GlobalSettings.objects.create()
\ No newline at end of file
+        GlobalSettings.objects.create()
+
+@receiver(post_migrate)
+def install_search_triggers(sender, using="default", **kwargs):
+    if sender.name == "emission":
+        install_triggers(connections[using])
+
+@receiver(post_delete, sender=EmissionFile)
+def update_emission_file_count(sender, instance, **kwargs):
+    # Files removed for good (admin actions, cascades) bypass EmissionFile.save()
+    if instance.is_active:
+        add_file_count(instance.emission_id, -1)
+    if instance.blob_id:
+        update_blob_references(Blob.all_objects.filter(pk=instance.blob_id))
+
+@receiver(post_save, sender=Sequence)
+def leave_deleted_native_sequence(sender, instance, **kwargs):
+    # soft deletes go through save(), the counter keeps the last number so a
+    # restored sequence creates its SEQUENCE again after it
+    if not instance.is_active:
+        leave_native_sequence(instance)
+        Sequence.all_objects.filter(
+            pk=instance.pk, sequence__lt=instance.sequence
+        ).update(sequence=instance.sequence)
+
+@receiver(post_delete, sender=Sequence)
+def drop_deleted_native_sequence(sender, instance, **kwargs):
+    drop_native_sequence(instance)
+
+@receiver(post_save, sender=UserDepartment)
+@receiver(post_delete, sender=UserDepartment)
+def invalidate_user_department_membership(sender, instance, **kwargs):
+    # soft deletes go through save() as well
+    invalidate([instance.user_id])
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_membership(sender, instance, **kwargs):
+    invalidate([instance.pk])
+
+@receiver(post_save, sender=Department)
+def invalidate_department_membership(sender, instance, **kwargs):
+    # the cached rows carry the department, its members read it again
+    invalidate(
+        UserDepartment.all_objects.filter(department=instance).values_list(
+            "user_id", flat=True
+        )
+    )
+
+@receiver(post_save, sender=GlobalSettings)
+@receiver(post_delete, sender=GlobalSettings)
+def invalidate_global_settings(sender, instance, **kwargs):
+    global_settings.invalidate()
@@ -1,3 +1,1599 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import querystats
+from .allocation import (
+    _blocks,
+    allocate,
+    drop_native_sequence,
+    leave_native_sequence,
+    native_sequence_name,
+    release_blocks,
+    sync_native_sequence,
+)
+from .audit import audit, repair
+from .management.commands.benchmark_allocation import PATHS
+from .batches import BatchFailed, create_batch
+from .blobs import collect_blobs
+from .idempotency import IdempotencyError, run_once
+from .jobs import claim_next, enqueue, fail_expired, handlers, run
+from .listing import department_pages
+from .membership import cache_stats, reset_cache_stats
+from .reservations import ReservationExpired, confirm, expire_reservations, reserve
+from .search import search
+from .uploads import UploadError, _sha256, append_chunk, expire_uploads, part_path
+from .models import (
+    ApiToken,
+    Blob,
+    CustomUser,
+    Department,
+    Document,
+    Emission,
+    EmissionFile,
+    GlobalSettings,
+    IdempotencyKey,
+    Job,
+    Reservation,
+    Sequence,
+    SequenceGap,
+    UploadSession,
+    UserDepartment,
+    Year,
+)
+
+# Tables that grow with the use of the application, a full scan of any of
+# them in a listing is a regression.
+HOT_TABLES = [
+    "emission_emission",
+    "emission_emissionfile",
+    "emission_sequence",
+    "emission_userdepartment",
+]
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    EMISSION_SHARED_CACHE=True,
+)
+class SeededTestCase(TestCase):
+    """
+    Four departments administrated by the test user, with three sequences
+    of 200 emissions each and some files.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.document = document = Document.objects.create(name="Report")
+        cls.year = year = Year.objects.create(year=2024)
+        cls.user = CustomUser.objects.create(username="admin", email="admin@x.com")
+        others = [
+            CustomUser.objects.create(username=f"user{index}", email=f"{index}@x.com")
+            for index in range(5)
+        ]
+        cls.departments = []
+        for index in range(4):
+            department = Department.objects.create(
+                name=f"Department {index}", description="-"
+            )
+            cls.departments.append(department)
+            UserDepartment.objects.create(
+                user=cls.user, department=department, can_administrate=True
+            )
+            for other in others:
+                UserDepartment.objects.create(user=other, department=department)
+            for _ in range(3):
+                sequence = Sequence.objects.create(
+                    department=department, document=document, year=year, sequence=0
+                )
+                Emission.objects.bulk_create(
+                    Emission(
+                        sequence=sequence,
+                        user=[cls.user, *others][number % 6],
+                        number=number,
+                        detail=f"Detail {number}",
+                        destination="Destination",
+                        received=number % 3 == 0,
+                        user_received=cls.user if number % 3 == 0 else None,
+                        is_active=number % 10 != 0,
+                    )
+                    for number in range(1, 201)
+                )
+        cls.emission = Emission.objects.filter(user=cls.user).first()
+        EmissionFile.objects.bulk_create(
+            EmissionFile(emission=emission, file="emission_files/test.pdf")
+            for emission in Emission.objects.all()[:300]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+
+class AllocationTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+
+    def test_consecutive_numbers(self):
+        self.assertEqual(list(allocate(self.sequence, 3)), [11, 12, 13])
+        self.assertEqual(list(allocate(self.sequence)), [14])
+        self.sequence.refresh_from_db()
+        self.assertEqual(self.sequence.sequence, 14)
+
+    def test_stale_instance(self):
+        stale = Sequence.objects.get(pk=self.sequence.pk)
+        allocate(self.sequence, 2)
+        self.assertEqual(list(allocate(stale)), [13])
+
+    def test_rollback(self):
+        allocate(self.sequence)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                allocate(self.sequence, 5)
+                raise RuntimeError
+        # the numbers of the rolled back transaction were never used, the
+        # committed one is not handed out again
+        self.assertEqual(list(allocate(self.sequence)), [12])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            allocate(self.sequence, 0)
+        self.sequence.delete()
+        with self.assertRaises(Sequence.DoesNotExist):
+            allocate(self.sequence)
+
+
+class HiLoAllocationTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+            allocation=Sequence.HILO,
+            block_size=5,
+        )
+        self.addCleanup(_blocks.pop, self.sequence.pk, None)
+
+    def allocate(self, quantity=1):
+        with self.captureOnCommitCallbacks(execute=True):
+            return list(allocate(self.sequence, quantity))
+
+    def gaps(self):
+        return list(
+            SequenceGap.objects.filter(sequence=self.sequence).values_list(
+                "start", "end", "reason"
+            )
+        )
+
+    def test_block(self):
+        self.assertEqual(self.allocate(), [11])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.allocate(4), [12, 13, 14, 15])
+        self.assertEqual(self.allocate(), [16])
+        self.sequence.refresh_from_db()
+        self.assertEqual(self.sequence.sequence, 20)
+        self.assertEqual(self.gaps(), [])
+
+    def test_undersized_block(self):
+        self.allocate(3)
+        self.assertEqual(self.allocate(3), [16, 17, 18])
+        self.assertEqual(self.gaps(), [(14, 15, "block replaced")])
+        self.assertEqual(self.allocate(2), [19, 20])
+
+    def test_rollback(self):
+        self.allocate()
+        self.allocate(4)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    allocate(self.sequence, 2)
+                    raise RuntimeError
+        # the block of the rolled back transaction is not served from memory
+        self.assertEqual(self.allocate(2), [16, 17])
+        self.assertEqual(self.gaps(), [])
+
+    def test_rollback_cached_block(self):
+        self.allocate()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.assertEqual(list(allocate(self.sequence, 2)), [12, 13])
+                raise RuntimeError
+        # the counter is past 12 and 13, the next allocation records them
+        self.assertEqual(self.allocate(), [14])
+        self.assertEqual(self.gaps(), [(12, 13, "rolled back")])
+        self.assertEqual(self.allocate(), [15])
+        self.assertEqual(len(self.gaps()), 1)
+
+    def test_release(self):
+        self.allocate(2)
+        release_blocks("test")
+        self.assertEqual(self.gaps(), [(13, 15, "test")])
+        self.assertEqual(self.allocate(), [16])
+
+    def test_mode_changed(self):
+        self.allocate()
+        self.sequence.refresh_from_db()
+        self.sequence.allocation = Sequence.GAPLESS
+        self.sequence.save()
+        self.assertEqual(self.allocate(), [16])
+        self.assertEqual(self.gaps(), [(12, 15, "mode changed")])
+        self.assertNotIn(self.sequence.pk, _blocks)
+
+
+class NativeAllocationTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+            allocation=Sequence.NATIVE,
+        )
+
+    def test_first_allocation(self):
+        self.assertEqual(list(allocate(self.sequence, 3)), [11, 12, 13])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL SEQUENCE")
+    def test_sync_never_rewinds(self):
+        allocate(self.sequence, 3)
+        self.sequence.sequence = 5
+        sync_native_sequence(self.sequence)
+        self.assertEqual(list(allocate(self.sequence)), [14])
+        self.sequence.sequence = 50
+        sync_native_sequence(self.sequence)
+        self.assertEqual(list(allocate(self.sequence)), [51])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL SEQUENCE")
+    def test_stale_mirror(self):
+        Sequence.objects.filter(pk=self.sequence.pk).update(sequence=20)
+        self.assertEqual(list(allocate(self.sequence)), [21])
+
+    def test_leave(self):
+        allocate(self.sequence, 3)
+        self.sequence.refresh_from_db()
+        leave_native_sequence(self.sequence)
+        self.sequence.allocation = Sequence.GAPLESS
+        self.sequence.save()
+        self.assertEqual(list(allocate(self.sequence)), [14])
+        # the SEQUENCE is gone, going back to native mode starts from the
+        # counter again
+        self.sequence.refresh_from_db()
+        self.sequence.allocation = Sequence.NATIVE
+        self.sequence.save()
+        self.assertEqual(list(allocate(self.sequence)), [15])
+
+    def native_sequences(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass(%s)", [native_sequence_name(self.sequence)]
+            )
+            return [name for (name,) in cursor.fetchall() if name]
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL SEQUENCE")
+    def test_soft_delete(self):
+        allocate(self.sequence, 3)
+        self.sequence.delete()
+        self.assertEqual(self.native_sequences(), [])
+        self.sequence.refresh_from_db()
+        self.assertEqual(self.sequence.sequence, 13)
+        self.sequence.is_active = True
+        self.sequence.save()
+        self.assertEqual(list(allocate(self.sequence)), [14])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL SEQUENCE")
+    def test_hard_delete(self):
+        allocate(self.sequence)
+        Sequence.all_objects.filter(pk=self.sequence.pk).delete()
+        self.assertEqual(self.native_sequences(), [])
+
+    def test_delete_without_sequence(self):
+        self.sequence.delete()
+        Sequence.all_objects.filter(pk=self.sequence.pk).delete()
+        self.assertFalse(Sequence.all_objects.filter(pk=self.sequence.pk).exists())
+
+
+@override_settings(EMISSION_BATCH_CHUNK_SIZE=3)
+class BatchTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+
+    def create(self, quantity, progress=None):
+        return create_batch(
+            self.sequence, quantity, self.user, "Detail", "Destination", progress
+        )
+
+    def test_chunks(self):
+        progress = []
+        batch = self.create(7, lambda *args: progress.append(args))
+        self.assertEqual(progress, [(3, 7), (6, 7), (7, 7)])
+        emissions = Emission.objects.filter(batch=batch).order_by("number")
+        self.assertEqual(
+            list(emissions.values_list("number", flat=True)), list(range(11, 18))
+        )
+        self.assertEqual(emissions.first().detail, f"1/7: Detail ({batch})")
+
+    def test_failed_chunk(self):
+        bulk_create = Emission.objects.bulk_create
+        chunks = []
+
+        def failing_bulk_create(emissions, **kwargs):
+            chunks.append(emissions)
+            if len(chunks) == 2:
+                raise DatabaseError("disk full")
+            return bulk_create(emissions, **kwargs)
+
+        with mock.patch.object(Emission.objects, "bulk_create", failing_bulk_create):
+            with self.assertRaises(BatchFailed):
+                self.create(7)
+        self.assertEqual(Emission.objects.filter(sequence=self.sequence).count(), 3)
+        self.assertEqual(
+            list(
+                SequenceGap.objects.filter(sequence=self.sequence).values_list(
+                    "start", "end", "reason"
+                )
+            ),
+            [(14, 17, "batch failed")],
+        )
+
+
+@override_settings(EMISSION_BATCH_CHUNK_SIZE=2, EMISSION_BATCH_ASYNC_THRESHOLD=5)
+class JobTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+
+    def enqueue(self, quantity=5, sequence=None):
+        return enqueue(
+            "emission_batch",
+            self.user,
+            {
+                "sequence": str(sequence or self.sequence.pk),
+                "quantity": quantity,
+                "user": str(self.user.pk),
+                "detail": "Detail",
+                "destination": "Destination",
+            },
+            total=quantity,
+        )
+
+    def test_queued_batch(self):
+        response = self.client.post(
+            f"/emission/{self.departments[0].id}/new_batch/",
+            {
+                "sequence": self.sequence.pk,
+                "quantity": 5,
+                "detail": "Detail",
+                "destination": "Destination",
+            },
+        )
+        job = Job.objects.get()
+        self.assertRedirects(response, f"/emission/jobs/{job.id}/")
+        self.assertEqual(job.status, Job.PENDING)
+
+    def test_claim(self):
+        first = self.enqueue()
+        second = self.enqueue()
+        self.assertEqual(claim_next(), first)
+        self.assertEqual(claim_next(), second)
+        self.assertIsNone(claim_next())
+        first.refresh_from_db()
+        self.assertEqual(first.status, Job.RUNNING)
+        self.assertIsNotNone(first.heartbeat_at)
+
+    def test_run(self):
+        self.enqueue()
+        job = run(claim_next())
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual((job.progress, job.total), (5, 5))
+        self.assertEqual(Emission.objects.filter(batch=job.result["batch"]).count(), 5)
+
+    def test_failed(self):
+        self.enqueue(sequence=uuid.uuid4())
+        job = run(claim_next())
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn("DoesNotExist", job.error)
+        response = self.client.get(f"/emission/jobs/{job.id}/")
+        self.assertNotContains(response, "window.location.reload")
+
+    def test_expired(self):
+        job = self.enqueue()
+        claim_next()
+        Job.objects.filter(pk=job.pk).update(
+            heartbeat_at=timezone.now() - timedelta(hours=1)
+        )
+        response = self.client.get(f"/emission/jobs/{job.id}/")
+        self.assertNotContains(response, "window.location.reload")
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIsNone(claim_next())
+
+    def test_alive(self):
+        job = self.enqueue()
+        claim_next()
+        self.assertIsNone(claim_next())
+        response = self.client.get(f"/emission/jobs/{job.id}/")
+        self.assertContains(response, "window.location.reload")
+
+    def test_lost_lease(self):
+        job = self.enqueue()
+        claim_next()
+
+        def expire_then_finish(job, progress, **payload):
+            Job.objects.filter(pk=job.pk).update(
+                heartbeat_at=timezone.now() - timedelta(hours=1)
+            )
+            fail_expired()
+            return {"batch": None}
+
+        with mock.patch.dict(handlers, {"emission_batch": expire_then_finish}):
+            job = run(job)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.error, "The worker running the job stopped")
+        self.assertIsNone(job.result)
+
+    @override_settings(EMISSION_JOB_LEASE=0.03)
+    def test_heartbeat_between_chunks(self):
+        job = self.enqueue()
+        claim_next()
+
+        def slow_chunk(job, progress, **payload):
+            time.sleep(0.1)
+            return {}
+
+        with mock.patch.dict(handlers, {"emission_batch": slow_chunk}):
+            with mock.patch("emission.jobs.heartbeat", return_value=True) as beat:
+                self.assertEqual(run(job).status, Job.DONE)
+        self.assertGreaterEqual(beat.call_count, 2)
+
+
+class ApiTests(SeededTestCase):
+    url = "/emission/api/emissions/"
+
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+        self.api_token = ApiToken(user=self.user, name="Test")
+        self.token = self.api_token.set_token()
+        self.api_token.save()
+
+    def post(self, body, token=None, **headers):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        return self.client.post(
+            self.url,
+            body,
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Token {token or self.token}",
+            **headers,
+        )
+
+    def test_token(self):
+        self.client.logout()
+        self.assertEqual(self.post({"emissions": []}, token="wrong").status_code, 401)
+        response = self.client.post(self.url, "{}", content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+        self.api_token.refresh_from_db()
+        self.assertIsNone(self.api_token.last_used_at)
+
+    def test_emissions(self):
+        self.client.logout()
+        sequence = str(self.sequence.pk)
+        response = self.post(
+            {
+                "emissions": [
+                    {"sequence": sequence, "detail": "One"},
+                    {"sequence": sequence, "detail": "Many", "quantity": 3},
+                ]
+            }
+        )
+        self.assertEqual(response.status_code, 201)
+        single, batch = response.json()["emissions"]
+        self.assertEqual(single["numbers"], [11])
+        self.assertIsNone(single["batch"])
+        self.assertEqual(batch["numbers"], [12, 13, 14])
+        self.assertEqual(Emission.objects.filter(batch=batch["batch"]).count(), 3)
+        self.api_token.refresh_from_db()
+        self.assertIsNotNone(self.api_token.last_used_at)
+
+    def test_other_department(self):
+        department = Department.objects.create(name="Other", description="-")
+        sequence = Sequence.objects.create(
+            department=department, document=self.document, year=self.year, sequence=0
+        )
+        response = self.post({"emissions": [{"sequence": str(sequence.pk)}]})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Emission.objects.filter(sequence=sequence).exists())
+
+    def test_invalid_quantity(self):
+        sequence = str(self.sequence.pk)
+        for quantity in ["1e400", "1.9", "true", '"3"', "0", "null"]:
+            with self.subTest(quantity=quantity):
+                body = (
+                    f'{{"emissions": [{{"sequence": "{sequence}", '
+                    f'"quantity": {quantity}}}]}}'
+                )
+                self.assertEqual(self.post(body).status_code, 400)
+        self.assertFalse(Emission.objects.filter(sequence=self.sequence).exists())
+
+    @override_settings(EMISSION_BATCH_MAX_QUANTITY=5)
+    def test_max_quantity(self):
+        item = {"sequence": str(self.sequence.pk), "quantity": 3}
+        self.assertEqual(self.post({"emissions": [item, item]}).status_code, 400)
+
+
+@override_settings(EMISSION_BATCH_CHUNK_SIZE=2)
+class IdempotencyTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+        self.url = f"/emission/{self.departments[0].id}/new_batch/"
+
+    def post(self, key="key", **data):
+        return self.client.post(
+            self.url,
+            {
+                "sequence": self.sequence.pk,
+                "quantity": 3,
+                "detail": "Detail",
+                "destination": "Destination",
+                "idempotency_key": key,
+                **data,
+            },
+        )
+
+    def emitted(self):
+        return Emission.objects.filter(sequence=self.sequence).count()
+
+    def test_retry(self):
+        self.assertEqual(self.post().status_code, 302)
+        self.assertEqual(self.post().status_code, 302)
+        self.assertEqual(self.emitted(), 3)
+
+    def test_other_payload(self):
+        self.post()
+        response = self.post(detail="Other")
+        self.assertContains(response, "used for another request")
+        self.assertNotEqual(response.context["idempotency_key"], "key")
+        self.assertEqual(self.emitted(), 3)
+
+    def test_other_path(self):
+        self.post()
+        api_token = ApiToken(user=self.user, name="Test")
+        token = api_token.set_token()
+        api_token.save()
+        response = self.client.post(
+            "/emission/api/emissions/",
+            json.dumps({"emissions": [{"sequence": str(self.sequence.pk)}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Token {token}",
+            HTTP_IDEMPOTENCY_KEY="key",
+        )
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.emitted(), 3)
+
+    def test_running(self):
+        request = RequestFactory().post(
+            "/emission/api/emissions/",
+            "{}",
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="key",
+        )
+        with self.assertRaises(IdempotencyError) as caught:
+            run_once(request, self.user, lambda: run_once(request, self.user, dict))
+        self.assertEqual(caught.exception.status, 409)
+        # nothing was committed, the key is free again
+        self.assertEqual(
+            run_once(request, self.user, lambda: {"done": True}), {"done": True}
+        )
+
+    def test_failed_batch(self):
+        bulk_create = Emission.objects.bulk_create
+        chunks = []
+
+        def failing_bulk_create(emissions, **kwargs):
+            chunks.append(emissions)
+            if len(chunks) == 2:
+                raise DatabaseError("disk full")
+            return bulk_create(emissions, **kwargs)
+
+        with mock.patch.object(Emission.objects, "bulk_create", failing_bulk_create):
+            with self.assertRaises(BatchFailed):
+                self.post()
+        response = self.post()
+        self.assertContains(response, "failed after creating some emissions")
+        self.assertEqual(self.emitted(), 2)
+        claim = IdempotencyKey.objects.get(key="key")
+        self.assertEqual(claim.status, IdempotencyKey.FAILED)
+        self.assertEqual(claim.result["created"], 2)
+
+    def test_expired_key(self):
+        self.post()
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(self.post().status_code, 302)
+        self.assertEqual(self.emitted(), 6)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_key_given_back(self):
+        request = RequestFactory().post(
+            "/emission/api/emissions/",
+            "{}",
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="key",
+        )
+
+        def claimed_then_given_back(**kwargs):
+            # another request holds the key and fails before the lookup
+            raise IntegrityError("duplicate key")
+
+        with mock.patch.object(
+            IdempotencyKey.objects, "create", claimed_then_given_back
+        ):
+            with self.assertRaises(IdempotencyError) as caught:
+                run_once(request, self.user, dict)
+        self.assertEqual(caught.exception.status, 409)
+
+    def test_expire(self):
+        self.post()
+        self.post(key="old")
+        IdempotencyKey.objects.filter(key="old").update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        call_command("expire_idempotency_keys", stdout=io.StringIO())
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list("key", flat=True)), ["key"]
+        )
+
+
+class ReservationTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=10,
+        )
+
+    def reserve(self, quantity=2):
+        response = self.client.post(
+            f"/emission/{self.departments[0].id}/reserve/",
+            {"sequence": self.sequence.pk, "quantity": quantity},
+        )
+        self.assertRedirects(response, "/emission/reservations/")
+        return list(Reservation.objects.filter(status=Reservation.RESERVED))
+
+    def confirm(self, reservation):
+        return self.client.post(
+            f"/emission/reservations/{reservation.id}/confirm/",
+            {"detail": "Detail", "destination": "Destination"},
+        )
+
+    def test_confirm(self):
+        first, second = sorted(self.reserve(), key=lambda r: r.number)
+        self.assertEqual((first.number, second.number), (11, 12))
+        self.assertRedirects(self.confirm(second), "/emission/")
+        second.refresh_from_db()
+        self.assertEqual(second.status, Reservation.CONFIRMED)
+        self.assertEqual(second.emission.number, 12)
+        self.assertEqual(self.confirm(second).status_code, 404)
+
+    def test_expired(self):
+        reservation = self.reserve(1)[0]
+        Reservation.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertContains(self.confirm(reservation), "The reservation has expired")
+        self.assertEqual(expire_reservations(), 1)
+        # the number is recycled instead of left as a gap
+        self.assertEqual([r.number for r in self.reserve(1)], [11])
+        self.assertFalse(Emission.objects.filter(sequence=self.sequence).exists())
+
+    def test_left_department(self):
+        reservation = self.reserve(1)[0]
+        UserDepartment.objects.get(
+            user=self.user, department=self.departments[0]
+        ).delete()
+        self.assertEqual(self.confirm(reservation).status_code, 404)
+        self.assertFalse(Emission.objects.filter(sequence=self.sequence).exists())
+
+    def test_closed_sequence(self):
+        reservation = self.reserve(1)[0]
+        Sequence.objects.filter(pk=self.sequence.pk).update(can_emit=False)
+        self.assertEqual(self.confirm(reservation).status_code, 404)
+
+    def test_recycled_to_another_user(self):
+        stale = self.reserve(1)[0]
+        Reservation.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        other = CustomUser.objects.get(username="user0")
+        recycled = reserve(self.sequence, other)[0]
+        self.assertEqual(recycled.number, stale.number)
+        with self.assertRaises(ReservationExpired):
+            confirm(stale, "Detail", "Destination")
+        emission = confirm(recycled, "Detail", "Destination")
+        self.assertEqual((emission.user, emission.number), (other, 11))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class BenchmarkTests(TransactionTestCase):
+    """
+    Runs every path of benchmark_allocation, it needs committed data and
+    connections of its own.
+    """
+
+    def test_paths(self):
+        # The in-memory SQLite test database fails on concurrent writers
+        # instead of waiting for them.
+        workers = 4 if connection.vendor == "postgresql" else 1
+        for allocation in [Sequence.GAPLESS, Sequence.HILO]:
+            with self.subTest(allocation=allocation):
+                output = io.StringIO()
+                call_command(
+                    "benchmark_allocation",
+                    workers=workers,
+                    iterations=3,
+                    batch_size=2,
+                    block_size=4,
+                    allocation=allocation,
+                    stdout=output,
+                )
+                report = output.getvalue()
+                self.assertEqual(
+                    report.count("duplicates: 0 handed out, 0 stored; skipped: 0"),
+                    4,
+                    report,
+                )
+        self.assertFalse(Emission.all_objects.exists())
+
+    def test_native_cleanup(self):
+        with mock.patch(
+            "emission.management.commands.benchmark_allocation.drop_native_sequence",
+            wraps=drop_native_sequence,
+        ) as drop:
+            call_command(
+                "benchmark_allocation",
+                workers=1,
+                iterations=2,
+                allocation=Sequence.NATIVE,
+                stdout=io.StringIO(),
+            )
+        self.assertEqual(drop.call_count, len(PATHS))
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_class "
+                    "WHERE relkind = 'S' AND relname LIKE 'emission_seq_%%'"
+                )
+                self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class AuditTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=12,
+        )
+        Emission.objects.bulk_create(
+            Emission(
+                sequence=self.sequence,
+                user=self.user,
+                number=number,
+                is_active=number != 6,
+            )
+            for number in [1, 2, 2, 5, 6, 9]
+        )
+        SequenceGap.objects.create(
+            sequence=self.sequence, start=3, end=3, reason="block replaced"
+        )
+        Reservation.objects.create(
+            sequence=self.sequence,
+            user=self.user,
+            number=4,
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def report(self):
+        return audit(Sequence.objects.filter(pk=self.sequence.pk))[0]
+
+    def test_audit(self):
+        report = self.report()
+        # the soft deleted emission still holds its number
+        self.assertEqual(report["emissions"], 6)
+        self.assertEqual(report["max_number"], 9)
+        self.assertEqual(report["drift"], 3)
+        self.assertEqual(report["duplicates"], [(2, 2)])
+        self.assertEqual(report["gaps"], [(3, 4), (7, 8), (10, 12)])
+        self.assertEqual(report["unexplained_gaps"], [(7, 8), (10, 12)])
+
+    def test_repair(self):
+        self.assertEqual(repair([self.report()]), [])
+        Sequence.objects.filter(pk=self.sequence.pk).update(sequence=5)
+        report = self.report()
+        self.assertEqual(report["drift"], -4)
+        self.assertEqual(repair([report]), [self.sequence])
+        self.sequence.refresh_from_db()
+        self.assertEqual(self.sequence.sequence, 9)
+        self.assertEqual(self.report()["drift"], 0)
+
+    def test_view(self):
+        Sequence.objects.filter(pk=self.sequence.pk).update(sequence=5)
+        response = self.client.get("/emission/admin/audit/")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post("/emission/admin/audit/", {"sequence": "garbage"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            "/emission/admin/audit/", {"sequence": self.sequence.pk}
+        )
+        self.assertRedirects(response, "/emission/admin/audit/")
+        self.sequence.refresh_from_db()
+        self.assertEqual(self.sequence.sequence, 9)
+
+    def test_not_admin(self):
+        self.client.force_login(CustomUser.objects.get(username="user0"))
+        response = self.client.post(
+            "/emission/admin/audit/", {"sequence": self.sequence.pk}
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class DepartmentPagesTests(SeededTestCase):
+    ordering = ["received", "-number"]
+
+    def pages(self, departments=None, **cursors):
+        return department_pages(
+            Emission.objects.filter(user=self.user),
+            departments or self.departments,
+            RequestFactory().get("/", cursors),
+            self.ordering,
+            "sequence__department",
+        )
+
+    def expected(self, department):
+        return list(
+            Emission.objects.filter(user=self.user, sequence__department=department)
+            .order_by(*self.ordering, "pk")
+            .values_list("pk", flat=True)
+        )
+
+    def test_pages(self):
+        pages = self.pages()
+        for department in self.departments:
+            page = pages[department.id]
+            expected = self.expected(department)
+            self.assertEqual(page.count, len(expected))
+            self.assertEqual([emission.pk for emission in page], expected[:12])
+
+    def test_single_query(self):
+        # the totals and the pages of every department
+        with self.assertNumQueries(2):
+            self.pages()
+
+    def test_views(self):
+        for url in ["/emission/", "/emission/admin/"]:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(
+                    set(response.context["emissions_by_department"]),
+                    {department.id for department in self.departments},
+                )
+
+    def page(self, cursor=None):
+        department = self.departments[0]
+        cursors = {f"cursor_{department.id}": cursor} if cursor else {}
+        return self.pages([department], **cursors)[department.id]
+
+    def test_walk(self):
+        expected = self.expected(self.departments[0])
+        page = self.page()
+        self.assertFalse(page.has_previous())
+        seen = [emission.pk for emission in page]
+        while page.has_next():
+            page = self.page(page.next_cursor)
+            seen += [emission.pk for emission in page]
+        self.assertEqual(seen, expected)
+        # and back to the first page
+        seen = [emission.pk for emission in page]
+        while page.has_previous():
+            page = self.page(page.previous_cursor)
+            seen = [emission.pk for emission in page] + seen
+        self.assertEqual(seen, expected)
+
+    def test_last(self):
+        expected = self.expected(self.departments[0])
+        page = self.page("last")
+        self.assertEqual([emission.pk for emission in page], expected[-12:])
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    def test_invalid_cursor(self):
+        expected = self.expected(self.departments[0])
+        for cursor in ["garbage", "n" + "x" * 10, "nWzFd"]:
+            with self.subTest(cursor=cursor):
+                page = self.page(cursor)
+                self.assertEqual([emission.pk for emission in page], expected[:12])
+
+
+class SearchTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=Document.objects.create(name="Contract"),
+            year=self.year,
+            sequence=0,
+        )
+        self.emission = Emission.objects.create(
+            sequence=self.sequence,
+            user=self.user,
+            number=4242,
+            detail="Supply of printers",
+            destination="Springfield office",
+        )
+
+    def found(self, query):
+        return self.emission in search(Emission.objects.all(), query)
+
+    def test_text(self):
+        for query in ["printers", "PRINT", "springfield", "supply springfield"]:
+            with self.subTest(query=query):
+                self.assertTrue(self.found(query))
+        for query in ["scanners", "printers shelbyville", '"', "100%"]:
+            with self.subTest(query=query):
+                self.assertFalse(self.found(query))
+
+    def test_updated(self):
+        self.emission.detail = "Supply of scanners"
+        self.emission.save()
+        self.assertFalse(self.found("printers"))
+        self.assertTrue(self.found("scanners"))
+        Emission.objects.filter(pk=self.emission.pk).update(destination="Ogdenville")
+        self.assertTrue(self.found("ogdenville"))
+
+    def test_shortcuts(self):
+        self.assertTrue(self.found("4242"))
+        self.assertTrue(self.found("2024"))
+        self.assertTrue(self.found("contract"))
+        self.assertTrue(self.found(self.emission.date.strftime("%d/%m/%Y")))
+
+    def test_rank(self):
+        other = Emission.objects.create(
+            sequence=self.sequence,
+            user=self.user,
+            number=4243,
+            detail="Printers, printers and more printers",
+            destination="Springfield office",
+        )
+        results = search(Emission.objects.filter(sequence=self.sequence), "printers")
+        self.assertEqual(list(results.order_by("-search_rank")), [other, self.emission])
+
+
+class FileCountTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sequence = Sequence.objects.create(
+            department=self.departments[0],
+            document=self.document,
+            year=self.year,
+            sequence=0,
+        )
+        self.emission = Emission.objects.create(
+            sequence=self.sequence, user=self.user, number=1, detail="Detail"
+        )
+
+    def count(self, emission=None):
+        return Emission.all_objects.get(pk=(emission or self.emission).pk).file_count
+
+    def test_add_and_delete(self):
+        first = EmissionFile.objects.create(emission=self.emission)
+        second = EmissionFile.objects.create(emission=self.emission)
+        self.assertEqual(self.count(), 2)
+        first.description = "Signed"
+        first.save()
+        self.assertEqual(self.count(), 2)
+        first.delete()
+        first.delete()
+        self.assertEqual(self.count(), 1)
+        first.is_active = True
+        first.save()
+        self.assertEqual(self.count(), 2)
+        EmissionFile.all_objects.filter(pk=second.pk).delete()
+        self.assertEqual(self.count(), 1)
+
+    def test_moved(self):
+        other = Emission.objects.create(
+            sequence=self.sequence, user=self.user, number=2, detail="Other"
+        )
+        emission_file = EmissionFile.objects.create(emission=self.emission)
+        emission_file.emission = other
+        emission_file.save()
+        self.assertEqual((self.count(), self.count(other)), (0, 1))
+
+    def test_stale_instance(self):
+        stale = Emission.objects.get(pk=self.emission.pk)
+        EmissionFile.objects.create(emission=self.emission)
+        stale.detail = "Changed"
+        stale.save()
+        self.assertEqual(self.count(), 1)
+        self.assertEqual(Emission.objects.get(pk=stale.pk).detail, "Changed")
+
+    def test_deferred_instance(self):
+        emission = Emission.objects.only("detail").get(pk=self.emission.pk)
+        emission.detail = "Changed"
+        with self.assertNumQueries(1):
+            emission.save()
+        self.assertEqual(Emission.objects.get(pk=emission.pk).detail, "Changed")
+
+    def test_reconcile(self):
+        EmissionFile.objects.create(emission=self.emission)
+        Emission.all_objects.filter(pk=self.emission.pk).update(file_count=5)
+        call_command("reconcile_file_counts", stdout=io.StringIO())
+        self.assertEqual(self.count(), 1)
+
+
+class QueryPlanTests(SeededTestCase):
+    """
+    Runs the listing views on a seeded dataset and checks the plan of every
+    query they send, so a missing index shows up as a failed test instead of
+    as a slow page.
+    """
+
+    def full_scans(self, sql):
+        """
+        Returns the hot tables the plan of ``sql`` reads entirely.
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # On a small dataset a sequential scan is the cheapest plan,
+                # only a table without a usable index keeps it when disabled.
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}")
+                plan = [row[0] for row in cursor.fetchall()]
+                return [
+                    table
+                    for table in HOT_TABLES
+                    for line in plan
+                    if f"Seq Scan on {table} " in f"{line} "
+                ]
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            plan = [row[-1] for row in cursor.fetchall()]
+            return [
+                table
+                for table in HOT_TABLES
+                for line in plan
+                if line == f"SCAN {table}" or line.startswith(f"SCAN {table} ")
+            ]
+
+    def assertIndexed(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in queries.captured_queries:
+            if not query["sql"].startswith("SELECT"):
+                continue
+            with self.subTest(sql=query["sql"]):
+                self.assertEqual(self.full_scans(query["sql"]), [])
+
+    def test_index(self):
+        self.assertIndexed("/emission/")
+
+    def test_index_next_page(self):
+        response = self.client.get("/emission/")
+        department = self.departments[0]
+        cursor = response.context["emissions_by_department"][department.id].next_cursor
+        self.assertIsNotNone(cursor)
+        self.assertIndexed(f"/emission/?cursor_{department.id}={cursor}")
+
+    def test_admin_index(self):
+        self.assertIndexed("/emission/admin/")
+
+    def test_files(self):
+        self.assertIndexed(f"/emission/{self.emission.id}/files/")
+
+    def test_admin_files(self):
+        self.assertIndexed(f"/emission/admin/{self.emission.id}/files/")
+
+    def test_admin_index_users(self):
+        self.assertIndexed("/emission/admin/users/")
+
+    def test_admin_index_sequences(self):
+        self.assertIndexed("/emission/admin/sequences/")
+
+
+class QueryBudgetTests(SeededTestCase):
+    """
+    The listings read every tab with a fixed number of queries, whatever
+    the number of departments and rows per page.
+    """
+
+    # Session, user, totals and the pages of all the departments, the global
+    # settings and the departments of the user come from the cache.
+    LISTING_QUERIES = 4
+
+    def assertListingQueries(self, url):
+        self.client.get(url)
+        with self.assertNumQueries(self.LISTING_QUERIES):
+            self.client.get(url)
+
+    def test_index(self):
+        self.assertListingQueries("/emission/")
+
+    def test_index_search(self):
+        self.assertListingQueries("/emission/?q=detail")
+
+    def test_index_one_department(self):
+        UserDepartment.objects.filter(
+            user=self.user, department__in=self.departments[1:]
+        ).delete()
+        self.assertListingQueries("/emission/")
+
+    def test_admin_index(self):
+        self.assertListingQueries("/emission/admin/")
+
+    def test_admin_index_users(self):
+        self.assertListingQueries("/emission/admin/users/")
+
+    def test_admin_index_sequences(self):
+        self.assertListingQueries("/emission/admin/sequences/")
+
+    def test_admin_files_membership(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/emission/admin/{self.emission.id}/files/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sum('FROM "emission_userdepartment"' in q["sql"] for q in queries), 1
+        )
+
+
+class QueryStatsTests(SeededTestCase):
+    def setUp(self):
+        super().setUp()
+        querystats.reset()
+        self.user.is_staff = True
+        self.user.save()
+
+    @override_settings(EMISSION_QUERY_INSTRUMENTATION=True)
+    def test_summary(self):
+        self.client.get("/emission/")
+        response = self.client.get("/emission/admin/queries/")
+        views = {stats["view"]: stats for stats in response.context["views"]}
+        self.assertEqual(views["emissions:index"]["requests"], 1)
+        self.assertEqual(response.context["process"]["pid"], os.getpid())
+        self.assertContains(response, str(os.getpid()))
+        self.client.post("/emission/admin/queries/")
+        views = [stats["view"] for stats in querystats.summary()]
+        self.assertEqual(views, ["emissions:admin_queries"])
+
+
+class MembershipCacheTests(SeededTestCase):
+    """
+    The departments of the user are cached across requests and read again
+    once a membership changes.
+    """
+
+    def test_hits_and_misses(self):
+        reset_cache_stats()
+        self.client.get("/emission/")
+        self.client.get("/emission/")
+        self.assertEqual(cache_stats(), {"hits": 1, "misses": 1})
+
+    @override_settings(EMISSION_SHARED_CACHE=False)
+    def test_without_shared_cache(self):
+        reset_cache_stats()
+        self.client.get("/emission/")
+        self.assertEqual(self.client.get("/emission/admin/").status_code, 200)
+        UserDepartment.objects.filter(user=self.user).update(can_administrate=False)
+        self.assertEqual(self.client.get("/emission/admin/").status_code, 403)
+        self.assertEqual(cache_stats(), {"hits": 0, "misses": 0})
+
+    def test_revoked_admin(self):
+        self.assertEqual(self.client.get("/emission/admin/").status_code, 200)
+        for user_department in UserDepartment.objects.filter(user=self.user):
+            user_department.can_administrate = False
+            user_department.save()
+        self.assertEqual(self.client.get("/emission/admin/").status_code, 403)
+
+    def test_soft_deleted_membership(self):
+        url = f"/emission/{self.emission.id}/files/"
+        self.assertEqual(self.client.get(url).status_code, 200)
+        UserDepartment.objects.get(
+            user=self.user, department=self.emission.sequence.department
+        ).delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class GlobalSettingsCacheTests(SeededTestCase):
+    def test_saved_settings(self):
+        self.client.get("/emission/")
+        settings = GlobalSettings.objects.first()
+        settings.name = "Numbering"
+        settings.save()
+        response = self.client.get("/emission/")
+        self.assertEqual(response.context["global_settings"].name, "Numbering")
+
+    @override_settings(EMISSION_SHARED_CACHE=False)
+    def test_without_shared_cache(self):
+        self.client.get("/emission/")
+        GlobalSettings.objects.update(name="Numbering")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/emission/")
+        self.assertEqual(response.context["global_settings"].name, "Numbering")
+        # the middleware and the context processor share one read
+        self.assertEqual(
+            sum('FROM "emission_globalsettings"' in q["sql"] for q in queries), 1
+        )
+
+
+class MediaTestCase(SeededTestCase):
+    """
+    Stores the files of its tests in temporary directories, removed once
+    the class ran.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, root, ignore_errors=True)
+        media = override_settings(
+            MEDIA_ROOT=os.path.join(root, "media"),
+            EMISSION_UPLOAD_DIR=os.path.join(root, "uploads"),
+        )
+        media.enable()
+        cls.addClassCleanup(media.disable)
+        super().setUpClass()
+
+
+class DownloadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = EmissionFile(emission=self.emission)
+        self.file.file.save("scan.pdf", ContentFile(b"%PDF-1.4 scan"))
+        self.url = f"/emission/{self.emission.id}/files/{self.file.id}/download/"
+
+    def test_streamed(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-1.4 scan")
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertIn("attachment", response["Content-Disposition"])
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=5-7")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"1.4")
+        self.assertEqual(response["Content-Range"], "bytes 5-7/13")
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-4")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"scan")
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=20-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */13")
+
+    def test_changed_file_range(self):
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=5-7", HTTP_IF_RANGE='"0-0"'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        last_modified = response["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(EMISSION_ACCEL_REDIRECT_PREFIX="/protected/")
+    def test_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/protected/{self.file.file.name}"
+        )
+
+
+class _DroppedStream(io.BytesIO):
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data:
+            raise OSError("connection reset")
+        return data
+
+
+class UploadTests(MediaTestCase):
+    content = b"%PDF-1.4 " + b"x" * 1000
+
+    def setUp(self):
+        super().setUp()
+        self.url = f"/emission/{self.emission.id}/uploads/"
+
+    def create(self, checksum=None):
+        response = self.client.post(
+            self.url,
+            {
+                "filename": "scan.pdf",
+                "size": len(self.content),
+                "checksum": checksum or hashlib.sha256(self.content).hexdigest(),
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return response["Location"]
+
+    def patch(self, url, offset, data):
+        return self.client.patch(
+            url,
+            data,
+            content_type="application/offset+octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_chunked_upload(self):
+        url = self.create()
+        self.assertEqual(self.patch(url, 0, self.content[:600])["Upload-Offset"], "600")
+        self.assertEqual(self.patch(url, 0, self.content[:600]).status_code, 409)
+        self.assertEqual(self.client.get(url).json()["offset"], 600)
+        self.patch(url, 600, self.content[600:])
+        response = self.client.post(f"{url}finalize/")
+        self.assertEqual(response.status_code, 201)
+        emission_file = EmissionFile.objects.get(id=response.json()["file"])
+        with emission_file.file.open("rb") as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_dropped_connection(self):
+        url = self.create()
+        session = UploadSession.objects.get()
+        offset = append_chunk(
+            session, 0, _DroppedStream(self.content[:100]), len(self.content)
+        )
+        self.assertEqual(offset, 100)
+        self.patch(url, 100, self.content[100:])
+        self.assertEqual(self.client.post(f"{url}finalize/").status_code, 201)
+
+    def test_incomplete_upload(self):
+        url = self.create()
+        self.patch(url, 0, self.content[:10])
+        self.assertEqual(self.client.post(f"{url}finalize/").status_code, 409)
+
+    def test_checksum_mismatch(self):
+        url = self.create(checksum="0" * 64)
+        self.patch(url, 0, self.content)
+        self.assertEqual(self.client.post(f"{url}finalize/").status_code, 422)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finished_uploads_deleted(self):
+        finished, discarded = self.create(), self.create()
+        parts = [part_path(session) for session in UploadSession.objects.all()]
+        self.patch(finished, 0, self.content)
+        self.assertEqual(self.client.post(f"{finished}finalize/").status_code, 201)
+        self.assertEqual(self.client.delete(discarded).status_code, 204)
+        self.assertFalse(UploadSession.all_objects.exists())
+        self.assertFalse(any(os.path.exists(part) for part in parts))
+
+    def test_expired_uploads(self):
+        self.create()
+        UploadSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(expire_uploads(), 1)
+        self.assertFalse(UploadSession.all_objects.exists())
+
+    def test_concurrent_chunk(self):
+        self.create()
+        session = UploadSession.objects.get()
+        content = self.content
+
+        class Racing(io.BytesIO):
+            # another request sends the same chunk while this one is read
+            def read(self, size=-1):
+                if not self.tell():
+                    append_chunk(session, 0, io.BytesIO(content[:600]), 600)
+                return super().read(size)
+
+        with self.assertRaises(UploadError) as error:
+            append_chunk(session, 0, Racing(b"y" * 600), 600)
+        self.assertEqual(error.exception.status, 409)
+        session.refresh_from_db()
+        self.assertEqual(session.offset, 600)
+        with open(part_path(session), "rb") as part:
+            self.assertEqual(part.read(), self.content[:600])
+        # the chunks received are removed once copied or rejected
+        staged = [
+            name
+            for name in os.listdir(settings.EMISSION_UPLOAD_DIR)
+            if name.startswith(f"{session.pk}.part.")
+        ]
+        self.assertEqual(staged, [])
+
+    def test_hashed_before_lock(self):
+        url = self.create()
+        self.patch(url, 0, self.content)
+        calls = []
+        lock = UploadSession.objects.select_for_update
+
+        def hash_part(path):
+            calls.append("hash")
+            return _sha256(path)
+
+        def select_for_update():
+            calls.append("lock")
+            return lock()
+
+        with mock.patch("emission.uploads._sha256", hash_part):
+            with mock.patch.object(
+                UploadSession.objects, "select_for_update", select_for_update
+            ):
+                self.assertEqual(self.client.post(f"{url}finalize/").status_code, 201)
+        self.assertEqual(calls, ["hash", "lock"])
+
+    @override_settings(EMISSION_UPLOAD_MAX_SIZE=100)
+    def test_too_large(self):
+        response = self.client.post(
+            self.url,
+            {"filename": "scan.pdf", "size": 101, "checksum": "0" * 64},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(UploadSession.all_objects.exists())
+
+    def test_invalid_filename(self):
+        for filename in [["scan.pdf"], None, "", "uploads/"]:
+            with self.subTest(filename=filename):
+                response = self.client.post(
+                    self.url,
+                    {"filename": filename, "size": 10, "checksum": "0" * 64},
+                    content_type="application/json",
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class BlobTests(MediaTestCase):
+    def upload(self, filename):
+        response = self.client.post(
+            f"/emission/admin/{self.emission.id}/upload/",
+            {"file": SimpleUploadedFile(filename, b"%PDF-1.4 same scan")},
+        )
+        self.assertEqual(response.status_code, 302)
+        return EmissionFile.objects.filter(filename=filename).get()
+
+    def test_shared_content(self):
+        first = self.upload("first.pdf")
+        second = self.upload("second.pdf")
+        self.assertEqual(first.blob, second.blob)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(Blob.objects.get().references, 2)
+        response = self.client.get(
+            f"/emission/admin/{self.emission.id}/files/{second.id}/download/"
+        )
+        self.assertIn("second.pdf", response["Content-Disposition"])
+        self.assertEqual(
+            second.url, f"/emission/{self.emission.id}/files/{second.id}/download/"
+        )
+
+    def test_collect(self):
+        first = self.upload("first.pdf")
+        second = self.upload("second.pdf")
+        first.delete()
+        self.assertEqual(collect_blobs(), 0)
+        second.delete()
+        self.assertEqual(Blob.objects.get().references, 0)
+        # a deleted file can be restored, its content stays
+        self.assertEqual(collect_blobs(), 0)
+        second.is_active = True
+        second.save()
+        self.assertTrue(default_storage.exists(second.file.name))
+        EmissionFile.all_objects.filter(pk__in=[first.pk, second.pk]).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(collect_blobs(), 1)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(first.file.name))
+
+
+class ZipTests(MediaTestCase):
+    def attach(self, emission, filename, content):
+        self.client.post(
+            f"/emission/admin/{emission.id}/upload/",
+            {"file": SimpleUploadedFile(filename, content)},
+        )
+
+    def archive(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_emission(self):
+        self.attach(self.emission, "scan.pdf", b"%PDF-1.4 scan")
+        self.attach(self.emission, "scan.pdf", b"%PDF-1.4 other scan")
+        self.attach(self.emission, "notes.txt", b"notes " * 100)
+        archive = self.archive(f"/emission/{self.emission.id}/files/zip/")
+        self.assertEqual(
+            sorted(archive.namelist()), ["notes.txt", "scan (2).pdf", "scan.pdf"]
+        )
+        self.assertEqual(archive.read("scan.pdf"), b"%PDF-1.4 scan")
+        self.assertEqual(archive.getinfo("scan.pdf").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(
+            archive.getinfo("notes.txt").compress_type, zipfile.ZIP_DEFLATED
+        )
+
+    def test_batch(self):
+        batch = uuid.uuid4()
+        first = Emission.objects.filter(user=self.user).first()
+        second = (
+            Emission.objects.filter(user=self.user).exclude(number=first.number).first()
+        )
+        emissions = [first, second]
+        Emission.objects.filter(pk__in=[e.pk for e in emissions]).update(batch=batch)
+        for emission in emissions:
+            self.attach(emission, "scan.pdf", b"%PDF-1.4 scan")
+        archive = self.archive(f"/emission/admin/batches/{batch}/zip/")
+        self.assertEqual(
+            sorted(archive.namelist()),
+            sorted(
+                f"{emission.sequence.document.name} {emission.number}/scan.pdf"
+                for emission in emissions
+            ),
+        )
+        self.assertEqual(
+            self.client.get(f"/emission/batches/{uuid.uuid4()}/zip/").status_code, 404
+        )
@@ -0,0 +1,233 @@
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .blobs import attach_blob
+from .membership import get_membership
+from .models import EmissionFile, UploadSession
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class _StagedFile(File):
+    # The storage moves a file exposing its path instead of copying it
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def can_upload(user, emission):
+    """
+    Returns whether ``user`` may attach files to ``emission``: the admins
+    of its department, or its owner while the sequence can emit.
+    """
+    membership = get_membership(user)
+    department = emission.sequence.department_id
+    if membership.is_admin(department):
+        return True
+    return (
+        emission.user_id == user.pk
+        and membership.is_member(department)
+        and emission.sequence.can_emit
+    )
+
+
+def part_path(session):
+    return os.path.join(settings.EMISSION_UPLOAD_DIR, f"{session.pk}.part")
+
+
+def create_session(emission, user, filename, size, checksum, name="", description=""):
+    """
+    Starts the upload of a file of ``size`` bytes whose sha256 is
+    ``checksum``, its chunks are appended with :func:`append_chunk`.
+    """
+    if not isinstance(filename, str) or not os.path.basename(filename):
+        raise UploadError("A filename is required")
+    filename = os.path.basename(filename)
+    checksum = str(checksum).lower()
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise UploadError("The size must be a positive number of bytes")
+    if size > settings.EMISSION_UPLOAD_MAX_SIZE:
+        raise UploadError(
+            f"Files can not exceed {settings.EMISSION_UPLOAD_MAX_SIZE} bytes",
+            status=413,
+        )
+    if len(checksum) != 64 or any(char not in "0123456789abcdef" for char in checksum):
+        raise UploadError("The checksum must be the hexadecimal sha256 of the file")
+    session = UploadSession.objects.create(
+        emission=emission,
+        user=user,
+        filename=filename,
+        name=name,
+        description=description,
+        size=size,
+        checksum=checksum,
+        expires_at=timezone.now() + timedelta(seconds=settings.EMISSION_UPLOAD_TTL),
+    )
+    os.makedirs(settings.EMISSION_UPLOAD_DIR, exist_ok=True)
+    open(part_path(session), "wb").close()
+    return session
+
+
+def append_chunk(session, offset, stream, length):
+    """
+    Writes the ``length`` bytes of ``stream`` at ``offset`` of the upload.
+
+    The chunk is read from the client into a file of its own, in small
+    pieces so a worker never holds more than one of them in memory, and
+    without any lock or transaction. The upload is only locked to check the
+    offset again and copy the received bytes to its part file. When the
+    connection drops halfway the bytes received are kept, and the client
+    resumes from the new offset.
+
+    Returns:
+        int: The offset of the next chunk.
+    """
+    if length > settings.EMISSION_UPLOAD_CHUNK_SIZE:
+        raise UploadError(
+            f"Chunks can not exceed {settings.EMISSION_UPLOAD_CHUNK_SIZE} bytes",
+            status=413,
+        )
+    _check_offset(UploadSession.objects.filter(pk=session.pk).first(), offset, length)
+    chunk_path = f"{part_path(session)}.{uuid.uuid4().hex}"
+    try:
+        with open(chunk_path, "wb") as chunk:
+            _receive(stream, chunk, length)
+        with transaction.atomic():
+            # one chunk at a time, a retried request waits for the first one
+            # and then finds the offset moved
+            session = (
+                UploadSession.objects.select_for_update().filter(pk=session.pk).first()
+            )
+            _check_offset(session, offset, length)
+            with open(chunk_path, "rb") as chunk, open(
+                part_path(session), "r+b"
+            ) as part:
+                part.seek(offset)
+                shutil.copyfileobj(chunk, part, READ_SIZE)
+                # drops what a failed copy left after the last received byte
+                part.truncate()
+                session.offset = part.tell()
+            session.expires_at = timezone.now() + timedelta(
+                seconds=settings.EMISSION_UPLOAD_TTL
+            )
+            session.save(update_fields=["offset", "expires_at"])
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return session.offset
+
+
+def _check_offset(session, offset, length):
+    if session is None:
+        raise UploadError("No such upload", status=404)
+    if offset != session.offset:
+        raise UploadError(f"The upload is at offset {session.offset}", status=409)
+    if offset + length > session.size:
+        raise UploadError("The chunk goes past the size of the file")
+
+
+def _receive(stream, chunk, length):
+    received = 0
+    while received < length:
+        try:
+            data = stream.read(min(READ_SIZE, length - received))
+        except OSError:
+            # the connection dropped, the client resumes after the bytes
+            # that arrived
+            return
+        if not data:
+            return
+        chunk.write(data)
+        received += len(data)
+
+
+def finalize(session):
+    """
+    Checks the size and the sha256 of the received file and attaches it to
+    the emission of the upload, content already stored is not kept twice.
+
+    The file is hashed before the upload is locked, a complete upload takes
+    no more chunks so its part file can not change meanwhile.
+
+    Returns:
+        EmissionFile: The new file of the emission.
+    """
+    path = part_path(session)
+    session = _complete(UploadSession.objects.filter(pk=session.pk).first())
+    if _sha256(path) != session.checksum:
+        discard(session)
+        raise UploadError(
+            "The checksum does not match, upload the file again", status=422
+        )
+    with transaction.atomic():
+        # a retried request waits for the first one and then finds no upload
+        session = _complete(
+            UploadSession.objects.select_for_update().filter(pk=session.pk).first()
+        )
+        emission_file = EmissionFile(
+            emission=session.emission,
+            name=session.name,
+            description=session.description,
+        )
+        with open(path, "rb") as part:
+            attach_blob(
+                emission_file,
+                _StagedFile(part),
+                filename=session.filename,
+                checksum=session.checksum,
+            )
+        UploadSession.all_objects.filter(pk=session.pk).delete()
+    if os.path.exists(path):
+        os.remove(path)
+    return emission_file
+
+
+def _complete(session):
+    if session is None:
+        raise UploadError("No such upload", status=404)
+    if session.offset != session.size:
+        raise UploadError(
+            f"Only {session.offset} of {session.size} bytes were received",
+            status=409,
+        )
+    return session
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as part:
+        for data in iter(lambda: part.read(READ_SIZE), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def discard(session):
+    # finished uploads are of no use, they are not kept soft deleted
+    UploadSession.all_objects.filter(pk=session.pk).delete()
+    path = part_path(session)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def expire_uploads():
+    """
+    Discards the uploads nobody appended to for ``EMISSION_UPLOAD_TTL``
+    seconds, returning how many.
+    """
+    sessions = list(UploadSession.all_objects.filter(expires_at__lt=timezone.now()))
+    for session in sessions:
+        discard(session)
+    return len(sessions)
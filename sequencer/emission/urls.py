@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.urls import path, re_path
 from django.conf.urls.static import static
-from . import views
+from . import api, views
 
 app_name = 'emissions'
 urlpatterns = [
@@ -9,10 +9,19 @@ urlpatterns = [
     re_path(r'^(?P<id>[0-9a-f-]{36})/new/$', views.new, name='new'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/new_batch/$', views.new_batch, name='new_batch'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/edit/$', views.edit, name='edit'),
+    re_path(r'^(?P<id>[0-9a-f-]{36})/reserve/$', views.new_reservation, name='new_reservation'),
+    path('reservations/', views.reservations, name='reservations'),
+    re_path(r'^reservations/(?P<id>[0-9a-f-]{36})/confirm/$', views.confirm_reservation, name='confirm_reservation'),
+    re_path(r'^jobs/(?P<id>[0-9a-f-]{36})/$', views.job, name='job'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/upload/$', views.upload, name='upload'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/files/$', views.files, name='files'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/files/(?P<idfile>[0-9a-f-]{36})/delete/$', views.delete_file, name='delete_file'),
     re_path(r'^(?P<id>[0-9a-f-]{36})/files/(?P<idfile>[0-9a-f-]{36})/download/$', views.download_file, name='download_file'),
+    re_path(r'^(?P<id>[0-9a-f-]{36})/files/zip/$', views.download_zip, name='download_zip'),
+    re_path(r'^batches/(?P<batch>[0-9a-f-]{36})/zip/$', views.download_batch_zip, name='download_batch_zip'),
+    re_path(r'^(?P<id>[0-9a-f-]{36})/uploads/$', views.new_upload, name='new_upload'),
+    re_path(r'^(?P<id>[0-9a-f-]{36})/uploads/(?P<idupload>[0-9a-f-]{36})/$', views.upload_session, name='upload_session'),
+    re_path(r'^(?P<id>[0-9a-f-]{36})/uploads/(?P<idupload>[0-9a-f-]{36})/finalize/$', views.finalize_upload, name='finalize_upload'),
     path('admin/', views.admin_index, name='admin_index'),
     re_path(r'^admin/(?P<id>[0-9a-f-]{36})/receive/$', views.admin_receive, name='admin_receive'),
     re_path(r'^admin/(?P<id>[0-9a-f-]{36})/receive/remove$', views.admin_remove_received, name='admin_remove_received'),
@@ -23,9 +32,14 @@ urlpatterns = [
     re_path(r'^admin/(?P<id>[0-9a-f-]{36})/files/$', views.admin_files, name='admin_files'),
     re_path(r'^admin/(?P<id>[0-9a-f-]{36})/files/(?P<idfile>[0-9a-f-]{36})/delete/$', views.admin_delete_file, name='admin_delete_file'),
     re_path(r'^admin/(?P<id>[0-9a-f-]{36})/files/(?P<idfile>[0-9a-f-]{36})/download/$', views.admin_download_file, name='admin_download_file'),
+    re_path(r'^admin/(?P<id>[0-9a-f-]{36})/files/zip/$', views.admin_download_zip, name='admin_download_zip'),
+    re_path(r'^admin/batches/(?P<batch>[0-9a-f-]{36})/zip/$', views.admin_download_batch_zip, name='admin_download_batch_zip'),
     path('admin/users/', views.admin_index_users, name='admin_index_users'),
     re_path(r'^admin/users/(?P<id>[0-9a-f-]{36})/new/$', views.admin_new_user, name='admin_new_user'),
     re_path(r'^admin/users/(?P<id>[0-9a-f-]{36})/delete/$', views.admin_delete_user, name='admin_delete_user'),
+    path('admin/audit/', views.admin_audit, name='admin_audit'),
+    path('admin/queries/', views.admin_queries, name='admin_queries'),
+    path('api/emissions/', api.emissions, name='api_emissions'),
     path('admin/sequences/', views.admin_index_sequences, name='admin_index_sequences'),
     re_path(r'^admin/sequences/(?P<id>[0-9a-f-]{36})/new/$', views.admin_new_sequence, name='admin_new_sequence'),
     re_path(r'^admin/sequences/(?P<id>[0-9a-f-]{36})/toggle/$', views.admin_toggle_sequence_emit, name='admin_toggle_sequence_emit'),
@@ -1,13 +1,41 @@
-from datetime import datetime
+import json
 import uuid
-from django.http import Http404, HttpResponse, HttpResponseForbidden
-from django.db import transaction
-from django.db.models import Q, Count
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    JsonResponse,
+)
+from django.db.models import Q
 from django.utils import timezone
 from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse
+from django.views.decorators.http import require_http_methods, require_POST
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.models import Permission
-from django.core.paginator import Paginator
+from .allocation import refresh_native_mirrors
+from .archives import emission_folder, entry_names, zip_response
+from . import querystats
+from .audit import audit, repair
+from .batches import create_batch
+from .blobs import attach_blob
+from .downloads import file_response
+from .idempotency import IdempotencyError, get_key, run_once
+from .jobs import enqueue, fail_expired
+from .listing import department_pages
+from .membership import cache_stats, get_membership, reset_cache_stats
+from .reservations import ReservationExpired, confirm, reserve
+from .search import search
+from .uploads import (
+    UploadError,
+    append_chunk,
+    can_upload,
+    create_session,
+    discard,
+    finalize,
+)
 from .forms import (
     AdminEmissionByDepartmentBatchForm,
     AdminEmissionByDepartmentForm,
@@ -17,10 +45,78 @@ from .forms import (
     EmissionByDepartmentFormEdit,
     EmissionFileForm,
     EmissionForm,
+    ReservationConfirmForm,
+    ReservationForm,
     SequenceForm,
     UserDepartmentForm,
 )
-from .models import Department, Emission, EmissionFile, Sequence, UserDepartment
+from .models import (
+    Department,
+    Emission,
+    EmissionFile,
+    Job,
+    Reservation,
+    Sequence,
+    UploadSession,
+    UserDepartment,
+)
+
+
+# Columns read by the emission cards of the listings.
+EMISSION_CARD_FIELDS = [
+    "number",
+    "received",
+    "detail",
+    "destination",
+    "date",
+    "date_received",
+    "file_count",
+    "user__username",
+    "user_received__username",
+    "sequence__can_emit",
+    "sequence__document__name",
+    "sequence__year__year",
+]
+
+
+def emission_cards(queryset):
+    return queryset.select_related(
+        "user", "user_received", "sequence__document", "sequence__year"
+    ).only(*EMISSION_CARD_FIELDS)
+
+
+def emit_batch(form, user, owner):
+    quantity = int(form.cleaned_data["quantity"])
+    if quantity >= settings.EMISSION_BATCH_ASYNC_THRESHOLD:
+        # Large batches run in the job worker, not in this request
+        job = enqueue(
+            "emission_batch",
+            user,
+            {
+                "sequence": str(form.cleaned_data["sequence"].pk),
+                "quantity": quantity,
+                "user": str(owner.pk),
+                "detail": form.cleaned_data["detail"],
+                "destination": form.cleaned_data["destination"],
+            },
+            total=quantity,
+        )
+        return {"job": str(job.id)}
+    # Create new batch of emissions
+    batch = create_batch(
+        form.cleaned_data["sequence"],
+        quantity,
+        user=owner,
+        detail=form.cleaned_data["detail"],
+        destination=form.cleaned_data["destination"],
+    )
+    return {"batch": str(batch)}
+
+
+def retry_key(request, error):
+    # The first request may still finish, its key is kept to wait for it.
+    # Any other refused key is replaced, the next submit is a new request.
+    return get_key(request) if error.status == 409 else uuid.uuid4()
 
 
 # Create your views here.
@@ -30,60 +126,19 @@ def index(request):
     email = user.email  # their email
     username = user.username  # their username
     # emissions = Emission.objects.filter()
-    user_departments = UserDepartment.objects.filter(user=user)
-    emissions_by_department = {}
+    user_departments = get_membership(user).user_departments
     query = request.GET.get("q")
-    # is a date
-    query_date = None
-    if query:
-        try:
-            query_date = datetime.strptime(query, "%d/%m/%Y")
-        except ValueError:
-            query_date = None
-    # is a number
-    query_number = None
+    departments = [user_department.department for user_department in user_departments]
+    emissions_list = emission_cards(
+        Emission.objects.filter(user=user, sequence__department__in=departments)
+    )
+    ordering = ["received", "-number"]
     if query:
-        try:
-            query_number = int(query)
-        except ValueError:
-            query_number = None
-    for user_department in user_departments:
-        department = user_department.department
-        if query:
-            emissions_list = (
-                Emission.objects.filter(
-                    Q(sequence__department=department)
-                    & Q(user=user)
-                    & (
-                        Q(detail__icontains=query)
-                        | Q(destination__icontains=query)
-                        | Q(number=query_number)
-                        | Q(date=query_date)
-                        | Q(sequence__document__name__icontains=query)
-                        | Q(sequence__year__year=query_number)
-                    )
-                )
-                .annotate(
-                    file_count=Count(
-                        "emissionfile", filter=Q(emissionfile__is_active=True)
-                    )
-                )
-                .order_by("received", "-number")
-            )
-        else:
-            emissions_list = (
-                Emission.objects.filter(user=user, sequence__department=department)
-                .annotate(
-                    file_count=Count(
-                        "emissionfile", filter=Q(emissionfile__is_active=True)
-                    )
-                )
-                .order_by("received", "-number")
-            )
-        paginator = Paginator(emissions_list, 12)
-        page_number = request.GET.get(f"page_{department.id}", 1)
-        page_obj = paginator.get_page(page_number)
-        emissions_by_department[department.id] = page_obj
+        emissions_list = search(emissions_list, query)
+        ordering = ["-search_rank"] + ordering
+    emissions_by_department = department_pages(
+        emissions_list, departments, request, ordering, "sequence__department"
+    )
     tab = request.GET.get(f"tab", 0)
     if not str(tab).isdigit():
         tab = 0
@@ -104,22 +159,35 @@ def new(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(user=user, department=department)
-    if not user_departments:
+    if not get_membership(user).is_member(department):
         raise Http404("No such department")
     sequence = Sequence.objects.filter(department=department, can_emit=True).first()
     if not sequence:
         raise Http404("No sequence available")
+    key = get_key(request) or uuid.uuid4()
     if request.method == "POST":
         form = EmissionByDepartmentForm(
             request.POST, user=request.user, department=department
         )
         if form.is_valid():
-            emission = form.save()
-            return redirect("emissions:index")
+            try:
+                run_once(request, user, lambda: {"emissions": [str(form.save().id)]})
+            except IdempotencyError as error:
+                form.add_error(None, str(error))
+                key = retry_key(request, error)
+            else:
+                return redirect("emissions:index")
     else:
         form = EmissionByDepartmentForm(user=request.user, department=department)
-    return render(request, "emission/emission.html", {"form": form, "emission": None})
+    return render(
+        request,
+        "emission/emission.html",
+        {
+            "form": form,
+            "emission": None,
+            "idempotency_key": key,
+        },
+    )
 
 
 @login_required
@@ -127,40 +195,123 @@ def new_batch(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(user=user, department=department)
-    if not user_departments:
+    if not get_membership(user).is_member(department):
         raise Http404("No such department")
     sequence = Sequence.objects.filter(department=department, can_emit=True).first()
     if not sequence:
         raise Http404("No sequence available")
+    key = get_key(request) or uuid.uuid4()
     if request.method == "POST":
         form = EmissionByDepartmentBatchForm(
             request.POST, user=request.user, department=department
         )
         if form.is_valid():
-            # Create new batch of emissions
-            with transaction.atomic():
-                id_batch = uuid.uuid4()
-                quantity = int(form.cleaned_data["quantity"])
-                current = sequence.sequence
-                sequence.increment(quantity)
-                emissions = [
-                    Emission(
-                        sequence=sequence,
-                        detail=f'{i}/{quantity}: {form.cleaned_data["detail"]} ({id_batch})',
-                        destination=form.cleaned_data["destination"],
-                        user=request.user,
-                        number=current + i,
-                        batch=id_batch,
-                    )
-                    for i in range(1, quantity + 1)
-                ]
-                Emission.objects.bulk_create(emissions)
-
-            return redirect("emissions:index")
+            try:
+                result = run_once(
+                    request, user, lambda: emit_batch(form, user, request.user)
+                )
+            except IdempotencyError as error:
+                form.add_error(None, str(error))
+                key = retry_key(request, error)
+            else:
+                if "job" in result:
+                    return redirect("emissions:job", id=result["job"])
+                return redirect("emissions:index")
     else:
         form = EmissionByDepartmentBatchForm(user=request.user, department=department)
-    return render(request, "emission/emission.html", {"form": form, "emission": None})
+    return render(
+        request,
+        "emission/emission.html",
+        {
+            "form": form,
+            "emission": None,
+            "idempotency_key": key,
+        },
+    )
+
+
+@login_required
+def new_reservation(request, id):
+    user = request.user
+    uid = uuid.UUID(id, version=4)
+    department = get_object_or_404(Department, id=uid)
+    if not get_membership(user).is_member(department):
+        raise Http404("No such department")
+    if request.method == "POST":
+        form = ReservationForm(request.POST, user=user, department=department)
+        if form.is_valid():
+            reserve(form.cleaned_data["sequence"], user, form.cleaned_data["quantity"])
+            return redirect("emissions:reservations")
+    else:
+        form = ReservationForm(user=user, department=department)
+    return render(
+        request, "emission/reservation.html", {"form": form, "reservation": None}
+    )
+
+
+@login_required
+def reservations(request):
+    reservations = (
+        Reservation.objects.filter(
+            user=request.user,
+            status=Reservation.RESERVED,
+            expires_at__gte=timezone.now(),
+        )
+        .select_related("sequence__department", "sequence__document", "sequence__year")
+        .order_by("expires_at", "number")
+    )
+    return render(
+        request, "emission/reservations.html", {"reservations": reservations}
+    )
+
+
+@login_required
+def confirm_reservation(request, id):
+    user = request.user
+    uid = uuid.UUID(id, version=4)
+    reservation = get_object_or_404(
+        Reservation.objects.select_related("sequence"),
+        id=uid,
+        user=user,
+        status=Reservation.RESERVED,
+    )
+    # The user may have left the department since the number was reserved
+    if not get_membership(user).is_member(reservation.sequence.department_id):
+        raise Http404("No such department")
+    if not reservation.sequence.can_emit:
+        raise Http404("No sequence available")
+    if request.method == "POST":
+        form = ReservationConfirmForm(request.POST)
+        if form.is_valid():
+            try:
+                confirm(
+                    reservation,
+                    form.cleaned_data["detail"],
+                    form.cleaned_data["destination"],
+                )
+            except ReservationExpired:
+                form.add_error(None, "The reservation has expired")
+            else:
+                return redirect("emissions:index")
+    else:
+        form = ReservationConfirmForm()
+    return render(
+        request,
+        "emission/reservation.html",
+        {"form": form, "reservation": reservation},
+    )
+
+
+@login_required
+def job(request, id):
+    uid = uuid.UUID(id, version=4)
+    job = get_object_or_404(Job, id=uid)
+    if job.user != request.user:
+        raise Http404("No such job")
+    if job.status == Job.RUNNING and fail_expired(Job.objects.filter(pk=job.pk)):
+        # no worker is left to fail it, the page would poll forever
+        job.refresh_from_db()
+    return render(request, "emission/job.html", {"job": job})
 
 
 @login_required
@@ -170,10 +321,7 @@ def edit(request, id):
     emission = get_object_or_404(Emission, id=uid)
     if emission.user != user:
         raise Http404("No such emission")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(emission.sequence.department_id):
         raise Http404("No such department")
     if not emission.sequence.can_emit:
         raise Http404("No sequence available")
@@ -207,10 +355,7 @@ def files(request, id):
     emission = get_object_or_404(Emission, id=uid)
     if emission.user != user:
         raise Http404("No such emission")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(emission.sequence.department_id):
         raise Http404("No such department")
     files = EmissionFile.objects.filter(emission=emission)
     return render(
@@ -225,10 +370,7 @@ def upload(request, id):
     emission = get_object_or_404(Emission, id=uid)
     if emission.user != user:
         raise Http404("No such emission")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(emission.sequence.department_id):
         raise Http404("No such department")
     if not emission.sequence.can_emit:
         raise Http404("No sequence available")
@@ -240,7 +382,7 @@ def upload(request, id):
             # TODO URL if remote file
             # if not file.url:
             #     file.url = file.file.url
-            file.save()
+            attach_blob(file, form.cleaned_data["file"])
             return redirect("emissions:files", id=emission.id)
     else:
         form = EmissionFileForm()
@@ -256,10 +398,7 @@ def delete_file(request, id, idfile):
     file = get_object_or_404(EmissionFile, id=uidfile)
     if file.emission.user != user:
         raise Http404("No such emission")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=file.emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(file.emission.sequence.department_id):
         raise Http404("No such department")
     if not emission.sequence.can_emit:
         raise Http404("No sequence available")
@@ -276,76 +415,156 @@ def download_file(request, id, idfile):
     file = get_object_or_404(EmissionFile, id=uidfile)
     if file.emission.user != user:
         raise Http404("No such emission")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=file.emission.sequence.department
+    if not get_membership(user).is_member(file.emission.sequence.department_id):
+        raise Http404("No such department")
+    return file_response(request, file)
+
+
+def batch_files(batch, departments):
+    return (
+        EmissionFile.objects.filter(
+            emission__batch=uuid.UUID(batch, version=4),
+            emission__sequence__department__in=departments,
+        )
+        .select_related("emission__sequence__document")
+        .order_by("emission__number", "created_at")
     )
-    if not user_departments:
+
+
+@login_required
+def download_zip(request, id):
+    user = request.user
+    uid = uuid.UUID(id, version=4)
+    emission = get_object_or_404(Emission, id=uid)
+    if emission.user != user:
+        raise Http404("No such emission")
+    if not get_membership(user).is_member(emission.sequence.department_id):
         raise Http404("No such department")
-    response = HttpResponse(file.file, content_type="application/octet-stream")
-    response["Content-Disposition"] = f"attachment; filename={file.file.name}"
+    files = EmissionFile.objects.filter(emission=emission).order_by("created_at")
+    return zip_response(entry_names(files), f"emission-{emission.number}.zip")
+
+
+@login_required
+def download_batch_zip(request, batch):
+    user = request.user
+    files = batch_files(batch, get_membership(user).department_ids).filter(
+        emission__user=user
+    )
+    if not files:
+        raise Http404("No files in this batch")
+    return zip_response(
+        entry_names(files, folder=emission_folder),
+        f"batch-{batch}.zip",
+    )
+
+
+def upload_state(session, status=200):
+    response = JsonResponse(
+        {"id": str(session.id), "offset": session.offset, "size": session.size},
+        status=status,
+    )
+    response["Upload-Offset"] = str(session.offset)
+    response["Upload-Length"] = str(session.size)
+    return response
+
+
+def get_upload(request, id, idupload):
+    emission = get_object_or_404(
+        Emission.objects.select_related("sequence"), id=uuid.UUID(id, version=4)
+    )
+    if not can_upload(request.user, emission):
+        raise Http404("No such emission")
+    return get_object_or_404(
+        UploadSession,
+        id=uuid.UUID(idupload, version=4),
+        emission=emission,
+        user=request.user,
+        expires_at__gte=timezone.now(),
+    )
+
+
+@login_required
+@require_POST
+def new_upload(request, id):
+    user = request.user
+    uid = uuid.UUID(id, version=4)
+    emission = get_object_or_404(Emission.objects.select_related("sequence"), id=uid)
+    if not can_upload(user, emission):
+        raise Http404("No such emission")
+    try:
+        data = json.loads(request.body)
+        session = create_session(
+            emission,
+            user,
+            data.get("filename", ""),
+            data.get("size"),
+            data.get("checksum", ""),
+            name=str(data.get("name", "")),
+            description=str(data.get("description", "")),
+        )
+    except (ValueError, AttributeError):
+        return JsonResponse({"error": "Expected a JSON object"}, status=400)
+    except UploadError as error:
+        return JsonResponse({"error": str(error)}, status=error.status)
+    response = upload_state(session, status=201)
+    response["Location"] = reverse(
+        "emissions:upload_session", args=[emission.id, session.id]
+    )
     return response
 
 
+@login_required
+@require_http_methods(["GET", "HEAD", "PATCH", "DELETE"])
+def upload_session(request, id, idupload):
+    session = get_upload(request, id, idupload)
+    if request.method == "DELETE":
+        discard(session)
+        return HttpResponse(status=204)
+    if request.method == "PATCH":
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.headers.get("Content-Length") or 0)
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "Upload-Offset is required"}, status=400)
+        try:
+            append_chunk(session, offset, request, length)
+        except UploadError as error:
+            return JsonResponse({"error": str(error)}, status=error.status)
+        session.refresh_from_db()
+    return upload_state(session)
+
+
+@login_required
+@require_POST
+def finalize_upload(request, id, idupload):
+    session = get_upload(request, id, idupload)
+    try:
+        emission_file = finalize(session)
+    except UploadError as error:
+        return JsonResponse({"error": str(error)}, status=error.status)
+    return JsonResponse({"file": str(emission_file.id)}, status=201)
+
+
 # Create your views here.
 @login_required
 # @permission_required("emission.can_administrate", raise_exception=True)
 def admin_index(request):
     user = request.user  # the user
-    user_departments = UserDepartment.objects.filter(user=user, can_administrate=True)
+    user_departments = get_membership(user).administrated
     if not user_departments:
         return HttpResponseForbidden("You don't have permission to access this page")
-    emissions_by_department = {}
     query = request.GET.get("q")
-    # is a date
-    query_date = None
-    if query:
-        try:
-            query_date = datetime.strptime(query, "%d/%m/%Y")
-        except ValueError:
-            query_date = None
-    # is a number
-    query_number = None
+    departments = [user_department.department for user_department in user_departments]
+    emissions_list = emission_cards(
+        Emission.objects.filter(sequence__department__in=departments)
+    )
+    ordering = ["received", "-number"]
     if query:
-        try:
-            query_number = int(query)
-        except ValueError:
-            query_number = None
-    for user_department in user_departments:
-        department = user_department.department
-        if query:
-            emissions_list = (
-                Emission.objects.filter(
-                    Q(sequence__department=department)
-                    & (
-                        Q(detail__icontains=query)
-                        | Q(destination__icontains=query)
-                        | Q(number=query_number)
-                        | Q(date=query_date)
-                        | Q(sequence__document__name__icontains=query)
-                        | Q(sequence__year__year=query_number)
-                    )
-                )
-                .annotate(
-                    file_count=Count(
-                        "emissionfile", filter=Q(emissionfile__is_active=True)
-                    )
-                )
-                .order_by("received", "-number")
-            )
-        else:
-            emissions_list = (
-                Emission.objects.filter(sequence__department=department)
-                .annotate(
-                    file_count=Count(
-                        "emissionfile", filter=Q(emissionfile__is_active=True)
-                    )
-                )
-                .order_by("received", "-number")
-            )
-        paginator = Paginator(emissions_list, 12)
-        page_number = request.GET.get(f"page_{department.id}", 1)
-        page_obj = paginator.get_page(page_number)
-        emissions_by_department[department.id] = page_obj
+        emissions_list = search(emissions_list, query)
+        ordering = ["-search_rank"] + ordering
+    emissions_by_department = department_pages(
+        emissions_list, departments, request, ordering, "sequence__department"
+    )
     tab = request.GET.get(f"tab", 0)
     if not str(tab).isdigit():
         tab = 0
@@ -367,22 +586,33 @@ def admin_new(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(department):
         return HttpResponseForbidden("You don't have permission to access this page")
     sequence = Sequence.objects.filter(department=department, can_emit=True).first()
     if not sequence:
         raise Http404("No sequence available")
+    key = get_key(request) or uuid.uuid4()
     if request.method == "POST":
         form = AdminEmissionByDepartmentForm(request.POST, department=department)
         if form.is_valid():
-            emission = form.save()
-            return redirect("emissions:admin_index")
+            try:
+                run_once(request, user, lambda: {"emissions": [str(form.save().id)]})
+            except IdempotencyError as error:
+                form.add_error(None, str(error))
+                key = retry_key(request, error)
+            else:
+                return redirect("emissions:admin_index")
     else:
         form = AdminEmissionByDepartmentForm(department=department)
-    return render(request, "emission/emission.html", {"form": form, "emission": None})
+    return render(
+        request,
+        "emission/emission.html",
+        {
+            "form": form,
+            "emission": None,
+            "idempotency_key": key,
+        },
+    )
 
 
 @login_required
@@ -390,43 +620,39 @@ def admin_new_batch(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(department):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(user=user, department=department)
-    if not user_departments:
-        raise Http404("No such department")
     sequence = Sequence.objects.filter(department=department, can_emit=True).first()
     if not sequence:
         raise Http404("No sequence available")
+    key = get_key(request) or uuid.uuid4()
     if request.method == "POST":
         form = AdminEmissionByDepartmentBatchForm(request.POST, department=department)
         if form.is_valid():
-            # Create new batch of emissions
-            with transaction.atomic():
-                id_batch = uuid.uuid4()
-                quantity = int(form.cleaned_data["quantity"])
-                current = sequence.sequence
-                sequence.increment(quantity)
-                emissions = [
-                    Emission(
-                        sequence=sequence,
-                        detail=f'{i}/{quantity}: {form.cleaned_data["detail"]} ({id_batch})',
-                        destination=form.cleaned_data["destination"],
-                        user=form.cleaned_data["user"],
-                        number=current + i,
-                        batch=id_batch,
-                    )
-                    for i in range(1, quantity + 1)
-                ]
-                Emission.objects.bulk_create(emissions)
-
-            return redirect("emissions:admin_index")
+            try:
+                result = run_once(
+                    request,
+                    user,
+                    lambda: emit_batch(form, user, form.cleaned_data["user"]),
+                )
+            except IdempotencyError as error:
+                form.add_error(None, str(error))
+                key = retry_key(request, error)
+            else:
+                if "job" in result:
+                    return redirect("emissions:job", id=result["job"])
+                return redirect("emissions:admin_index")
     else:
         form = AdminEmissionByDepartmentBatchForm(department=department)
-    return render(request, "emission/emission.html", {"form": form, "emission": None})
+    return render(
+        request,
+        "emission/emission.html",
+        {
+            "form": form,
+            "emission": None,
+            "idempotency_key": key,
+        },
+    )
 
 
 @login_required
@@ -435,16 +661,8 @@ def admin_edit(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
-        raise Http404("No such department")
     if not emission.sequence.can_emit:
         raise Http404("No sequence available")
     if emission.received:
@@ -474,16 +692,8 @@ def admin_receive(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
-        raise Http404("No such department")
     if emission.received:
         raise Http404("Emission already received")
     if not emission.sequence.can_emit:
@@ -504,16 +714,8 @@ def admin_remove_received(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
-        raise Http404("No such department")
     if not emission.received:
         raise Http404("Emission not received")
     if not emission.sequence.can_emit:
@@ -536,16 +738,8 @@ def admin_files(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
-        raise Http404("No such department")
     files = EmissionFile.objects.filter(emission=emission)
     return render(
         request, "emission/admin_files.html", {"files": files, "emission": emission}
@@ -557,16 +751,8 @@ def admin_upload(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department
-    )
-    if not user_departments:
-        raise Http404("No such department")
     if request.method == "POST":
         form = EmissionFileForm(request.POST, request.FILES)
         if form.is_valid():
@@ -575,7 +761,7 @@ def admin_upload(request, id):
             # TODO URL if remote file
             # if not file.url:
             #     file.url = file.file.url
-            file.save()
+            attach_blob(file, form.cleaned_data["file"])
             return redirect("emissions:admin_files", id=emission.id)
     else:
         form = EmissionFileForm()
@@ -590,16 +776,10 @@ def admin_delete_file(request, id, idfile):
     uid = uuid.UUID(id, version=4)
     uidfile = uuid.UUID(idfile, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
     file = get_object_or_404(EmissionFile, id=uidfile)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=file.emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(file.emission.sequence.department_id):
         raise Http404("No such department")
     file.delete()
     return redirect("emissions:admin_files", id=emission.id)
@@ -611,45 +791,58 @@ def admin_download_file(request, id, idfile):
     uid = uuid.UUID(id, version=4)
     uidfile = uuid.UUID(idfile, version=4)
     emission = get_object_or_404(Emission, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=emission.sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(emission.sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
     file = get_object_or_404(EmissionFile, id=uidfile)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=file.emission.sequence.department
-    )
-    if not user_departments:
+    if not get_membership(user).is_member(file.emission.sequence.department_id):
         raise Http404("No such department")
-    response = HttpResponse(file.file, content_type="application/octet-stream")
-    response["Content-Disposition"] = f"attachment; filename={file.file.name}"
-    return response
+    return file_response(request, file)
+
+
+@login_required
+def admin_download_zip(request, id):
+    user = request.user
+    uid = uuid.UUID(id, version=4)
+    emission = get_object_or_404(Emission, id=uid)
+    if not get_membership(user).is_admin(emission.sequence.department_id):
+        return HttpResponseForbidden("You don't have permission to access this page")
+    files = EmissionFile.objects.filter(emission=emission).order_by("created_at")
+    return zip_response(entry_names(files), f"emission-{emission.number}.zip")
+
+
+@login_required
+def admin_download_batch_zip(request, batch):
+    user = request.user
+    departments = [
+        user_department.department_id
+        for user_department in get_membership(user).administrated
+    ]
+    files = batch_files(batch, departments)
+    if not files:
+        raise Http404("No files in this batch")
+    return zip_response(
+        entry_names(files, folder=emission_folder),
+        f"batch-{batch}.zip",
+    )
 
 
 @login_required
 # @permission_required("emission.can_administrate", raise_exception=True)
 def admin_index_users(request):
     user = request.user  # the user
-    user_departments = UserDepartment.objects.filter(user=user, can_administrate=True)
+    user_departments = get_membership(user).administrated
     if not user_departments:
         return HttpResponseForbidden("You don't have permission to access this page")
-    users_by_department = {}
     query = request.GET.get("q")
-    for user_department in user_departments:
-        department = user_department.department
-        if query:
-            users_list = UserDepartment.objects.filter(
-                Q(department=department) & (Q(user__username__icontains=query))
-            ).order_by("user__username")
-        else:
-            users_list = UserDepartment.objects.filter(department=department).order_by(
-                "user__username"
-            )
-        paginator = Paginator(users_list, 12)
-        page_number = request.GET.get(f"page_{department.id}", 1)
-        page_obj = paginator.get_page(page_number)
-        users_by_department[department.id] = page_obj
+    departments = [user_department.department for user_department in user_departments]
+    users_list = UserDepartment.objects.filter(
+        department__in=departments
+    ).select_related("user")
+    if query:
+        users_list = users_list.filter(user__username__icontains=query)
+    users_by_department = department_pages(
+        users_list, departments, request, ["user__username"], "department"
+    )
     tab = request.GET.get(f"tab", 0)
     if not str(tab).isdigit():
         tab = 0
@@ -671,14 +864,8 @@ def admin_new_user(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(department):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(user=user, department=department)
-    if not user_departments:
-        raise Http404("No such department")
     if request.method == "POST":
         form = UserDepartmentForm(request.POST, user=user, department=department)
         if form.is_valid():
@@ -697,10 +884,7 @@ def admin_delete_user(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     user_department = get_object_or_404(UserDepartment, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=user_department.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(user_department.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
     admins = UserDepartment.objects.filter(
         department=user_department.department, can_administrate=True
@@ -715,30 +899,29 @@ def admin_delete_user(request, id):
 # @permission_required("emission.can_administrate", raise_exception=True)
 def admin_index_sequences(request):
     user = request.user  # the user
-    user_departments = UserDepartment.objects.filter(user=user, can_administrate=True)
+    user_departments = get_membership(user).administrated
     if not user_departments:
         return HttpResponseForbidden("You don't have permission to access this page")
-    sequences_by_department = {}
     query = request.GET.get("q")
-    for user_department in user_departments:
-        department = user_department.department
-        if query:
-            sequences_list = Sequence.objects.filter(
-                Q(department=department)
-                & (
-                    Q(document__name__icontains=query)
-                    | Q(year__year=query)
-                    | Q(sequence__icontains=query)
-                )
-            ).order_by("year", "-can_emit", "sequence")
-        else:
-            sequences_list = Sequence.objects.filter(department=department).order_by(
-                "year", "-can_emit", "sequence"
-            )
-        paginator = Paginator(sequences_list, 12)
-        page_number = request.GET.get(f"page_{department.id}", 1)
-        page_obj = paginator.get_page(page_number)
-        sequences_by_department[department.id] = page_obj
+    departments = [user_department.department for user_department in user_departments]
+    sequences_list = Sequence.objects.filter(
+        department__in=departments
+    ).select_related("department", "document", "year")
+    if query:
+        sequences_list = sequences_list.filter(
+            Q(document__name__icontains=query)
+            | Q(year__year=query)
+            | Q(sequence__icontains=query)
+        )
+    sequences_by_department = department_pages(
+        sequences_list,
+        departments,
+        request,
+        ["year", "-can_emit", "sequence"],
+        "department",
+    )
+    for page_obj in sequences_by_department.values():
+        refresh_native_mirrors(page_obj)
     tab = request.GET.get(f"tab", 0)
     if not str(tab).isdigit():
         tab = 0
@@ -759,14 +942,8 @@ def admin_new_sequence(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     department = get_object_or_404(Department, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(department):
         return HttpResponseForbidden("You don't have permission to access this page")
-    user_departments = UserDepartment.objects.filter(user=user, department=department)
-    if not user_departments:
-        raise Http404("No such department")
     if request.method == "POST":
         form = SequenceForm(request.POST, department=department)
         if form.is_valid():
@@ -784,11 +961,51 @@ def admin_toggle_sequence_emit(request, id):
     user = request.user
     uid = uuid.UUID(id, version=4)
     sequence = get_object_or_404(Sequence, id=uid)
-    user_departments = UserDepartment.objects.filter(
-        user=user, department=sequence.department, can_administrate=True
-    )
-    if not user_departments:
+    if not get_membership(user).is_admin(sequence.department_id):
         return HttpResponseForbidden("You don't have permission to access this page")
     sequence.can_emit = not sequence.can_emit
-    sequence.save()
-    return redirect("emissions:admin_index_sequences")
\ No newline at end of file
+    # only the flag, the counter may have moved since the row was read
+    sequence.save(update_fields=["can_emit"])
+    return redirect("emissions:admin_index_sequences")
+
+
+@login_required
+def admin_audit(request):
+    user = request.user
+    user_departments = get_membership(user).administrated
+    if not user_departments:
+        return HttpResponseForbidden("You don't have permission to access this page")
+    departments = [user_department.department for user_department in user_departments]
+    sequences = Sequence.objects.filter(department__in=departments).select_related(
+        "department", "document", "year"
+    )
+    if request.method == "POST":
+        try:
+            sequence = uuid.UUID(request.POST.get("sequence", ""))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid sequence")
+        repair(audit(sequences.filter(id=sequence)))
+        return redirect("emissions:admin_audit")
+    report = audit(sequences.order_by("department__name", "year__year"))
+    return render(request, "emission/admin_audit.html", {"report": report})
+
+
+@login_required
+def admin_queries(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden("You don't have permission to access this page")
+    if request.method == "POST":
+        querystats.reset()
+        reset_cache_stats()
+        return redirect("emissions:admin_queries")
+    return render(
+        request,
+        "emission/admin_queries.html",
+        {
+            "views": querystats.summary(),
+            "process": querystats.process(),
+            "enabled": settings.EMISSION_QUERY_INSTRUMENTATION,
+            "threshold": settings.EMISSION_QUERY_REPEAT_THRESHOLD,
+            "membership_cache": cache_stats(),
+        },
+    )
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 from decouple import config
 import dj_database_url
@@ -64,6 +65,7 @@ SITE_ID = 1
 SOCIALACCOUNT_ADAPTER = "emission.models.CustomSocialAccountAdapter"
 LOGIN_REDIRECT_URL = "/"
 MIDDLEWARE = [
+    "emission.middleware.QueryInstrumentationMiddleware",
     "django.middleware.locale.LocaleMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -133,6 +135,31 @@ DJANGO_DATABASE_URL = config(
 DATABASES = {"default": dj_database_url.config(default=DJANGO_DATABASE_URL)}
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Without DJANGO_CACHE_BACKEND Django's memory cache is used, one per process.
+# Set it to a cache shared by all the workers (the file cache below on one
+# host, memcached or redis) to keep the departments of the users and the
+# global settings across requests, see EMISSION_SHARED_CACHE.
+
+DJANGO_CACHE_BACKEND = config("DJANGO_CACHE_BACKEND", default="")
+if DJANGO_CACHE_BACKEND:
+    CACHES = {
+        "default": {
+            "BACKEND": DJANGO_CACHE_BACKEND,
+            "LOCATION": config(
+                "DJANGO_CACHE_LOCATION",
+                default=os.path.join(tempfile.gettempdir(), "sequencer_cache"),
+            ),
+            "OPTIONS": {
+                "MAX_ENTRIES": config(
+                    "DJANGO_CACHE_MAX_ENTRIES", default=10000, cast=int
+                )
+            },
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -191,3 +218,37 @@ AUTH_USER_MODEL = "emission.CustomUser"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+
+# Batch emissions
+EMISSION_BATCH_MAX_QUANTITY = config("EMISSION_BATCH_MAX_QUANTITY", default=50000, cast=int)
+EMISSION_BATCH_CHUNK_SIZE = config("EMISSION_BATCH_CHUNK_SIZE", default=1000, cast=int)
+# Batches of this size or more are run by `manage.py run_jobs`
+EMISSION_BATCH_ASYNC_THRESHOLD = config("EMISSION_BATCH_ASYNC_THRESHOLD", default=1000, cast=int)
+# Seconds a running job may go without progress before it is failed as abandoned by its worker
+EMISSION_JOB_LEASE = config("EMISSION_JOB_LEASE", default=600, cast=int)
+# Seconds a retried request with the same Idempotency-Key returns the original emissions, older keys are free again
+EMISSION_IDEMPOTENCY_TTL = config("EMISSION_IDEMPOTENCY_TTL", default=3600, cast=int)
+# Seconds a reserved number waits for confirmation before it is recycled
+EMISSION_RESERVATION_TTL = config("EMISSION_RESERVATION_TTL", default=3600, cast=int)
+# Show the row estimate of the PostgreSQL planner instead of exact totals in the listings
+EMISSION_APPROXIMATE_COUNTS = config("EMISSION_APPROXIMATE_COUNTS", default=False, cast=bool)
+# Count the queries of every emission view, see /emission/admin/queries/
+EMISSION_QUERY_INSTRUMENTATION = config("EMISSION_QUERY_INSTRUMENTATION", default=False, cast=bool)
+# A statement run this many times in one request is reported as N+1
+EMISSION_QUERY_REPEAT_THRESHOLD = config("EMISSION_QUERY_REPEAT_THRESHOLD", default=5, cast=int)
+# Requests with more queries than this are logged
+EMISSION_QUERY_BUDGET = config("EMISSION_QUERY_BUDGET", default=20, cast=int)
+# Cache the departments of the users and the global settings, invalidations must reach every worker
+EMISSION_SHARED_CACHE = config("EMISSION_SHARED_CACHE", default=bool(DJANGO_CACHE_BACKEND), cast=bool)
+# Seconds the departments of a user stay cached, saving them through the ORM invalidates them
+EMISSION_MEMBERSHIP_CACHE_TIMEOUT = config("EMISSION_MEMBERSHIP_CACHE_TIMEOUT", default=300, cast=int)
+# Internal nginx location serving MEDIA_ROOT (e.g. /protected/), downloads are handed to it with X-Accel-Redirect
+EMISSION_ACCEL_REDIRECT_PREFIX = config("EMISSION_ACCEL_REDIRECT_PREFIX", default="")
+# Resumable uploads: chunks are staged here, outside MEDIA_ROOT so unfinished uploads are never served
+EMISSION_UPLOAD_DIR = config("EMISSION_UPLOAD_DIR", default=os.path.join(BASE_DIR, "uploads"))
+# Largest file accepted by a resumable upload, in bytes
+EMISSION_UPLOAD_MAX_SIZE = config("EMISSION_UPLOAD_MAX_SIZE", default=1024 * 1024 * 1024, cast=int)
+# Largest chunk accepted by one request, in bytes
+EMISSION_UPLOAD_CHUNK_SIZE = config("EMISSION_UPLOAD_CHUNK_SIZE", default=8 * 1024 * 1024, cast=int)
+# Seconds an upload without new chunks is kept before `manage.py expire_uploads` discards it
+EMISSION_UPLOAD_TTL = config("EMISSION_UPLOAD_TTL", default=86400, cast=int)